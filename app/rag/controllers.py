@@ -2,17 +2,24 @@ from flask import Blueprint, request, jsonify
 from app.utilities.logger import logger
 from app.utilities import responseHandler
 from app.utilities.verify_auth_token import token_required
+from app.utilities.single_flight import get_single_flight_stats
 from app.auth.constants import AuthSuccessMessages
-from app.rag.services import process_urls_for_indexing, create_collection, fetch_all_records, generate_query_response
+from app.rag.services import (process_urls_for_indexing, create_collection, fetch_all_records, generate_query_response,
+                              report_search_dimensions, get_dedup_stats)
 from typing import Dict
 from datetime import datetime, timedelta, timezone
-from config import SECRET_KEY
+from config import SECRET_KEY, SEARCH_VECTOR_DIMENSION
 import jwt
 
 # Defining the blueprint 'rag'
 mod_rag = Blueprint("rag", __name__, url_prefix='/rag')
 
 
+def is_non_negative_int(value) -> bool:
+    # JSON booleans are ints in Python, they are not valid sizes
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
 @mod_rag.route("/api/v1/health", methods=['GET'])
 @token_required
 def health() -> Dict:
@@ -41,12 +48,13 @@ def index_urls() -> Dict:
         urls = request_data['url']
 
         # For each URL scrape the data and process for indexing in vector DB
-        indexed_urls, failed_urls = process_urls_for_indexing(urls)
+        indexed_urls, failed_urls, dedup = process_urls_for_indexing(urls)
         status = "success" if len(failed_urls) == 0 else "failure"
         response = {
             "status": status,
             "indexed_url": indexed_urls,
-            "failed_url": failed_urls
+            "failed_url": failed_urls,
+            "dedup": dedup
         }
         return response
     except Exception as err:
@@ -63,7 +71,13 @@ def create_collection_endpoint():
     try:
         request_data = request.json
         collection_name = request_data['collection_name']
-        status = create_collection(collection_name)
+        search_dimension = request_data.get('search_dimension', SEARCH_VECTOR_DIMENSION)
+        if not is_non_negative_int(search_dimension):
+            return responseHandler.failure_response(
+                "search_dimension must be a non-negative integer.",
+                400
+            )
+        status = create_collection(collection_name, search_dimension)
         if status:
             return {"status": f"Collection '{collection_name}' created successfully."}
         else:
@@ -91,6 +105,59 @@ def fetch_all_records_endpoint():
             500
         )
 
+@mod_rag.route("/api/v1/dedup_stats", methods=['POST'])
+@token_required
+def dedup_stats_endpoint():
+    try:
+        request_data = request.json
+        collection_name = request_data['collection_name']
+        return {"status": "success", "data": get_dedup_stats(collection_name)}
+    except Exception as err:
+        logger.error('Error while fetching the dedup stats:', str(err))
+        return responseHandler.failure_response(
+            str(err),
+            500
+        )
+
+@mod_rag.route("/api/v1/single_flight_stats", methods=['GET'])
+@token_required
+def single_flight_stats_endpoint():
+    try:
+        return {"status": "success", "data": get_single_flight_stats()}
+    except Exception as err:
+        logger.error('Error while fetching the single-flight stats:', str(err))
+        return responseHandler.failure_response(
+            str(err),
+            500
+        )
+
+@mod_rag.route("/api/v1/search_dimension_report", methods=['POST'])
+@token_required
+def search_dimension_report_endpoint():
+    try:
+        request_data = request.json
+        collection_name = request_data['collection_name']
+        dimensions = request_data.get('dimensions', [256, 512])
+        limit = request_data.get('limit', 5)
+        if not isinstance(dimensions, list) or not all(is_non_negative_int(d) and d > 0 for d in dimensions):
+            return responseHandler.failure_response(
+                "dimensions must be a list of positive integers.",
+                400
+            )
+        if not (is_non_negative_int(limit) and limit > 0):
+            return responseHandler.failure_response(
+                "limit must be a positive integer.",
+                400
+            )
+        report = report_search_dimensions(collection_name, dimensions, limit)
+        return {"status": "success", "data": report}
+    except Exception as err:
+        logger.error('Error while reporting the search dimensions:', str(err))
+        return responseHandler.failure_response(
+            str(err),
+            500
+        )
+
 @mod_rag.route("/api/v1/chat", methods=['POST'])
 @token_required
 def query_documents():
@@ -0,0 +1,284 @@
+"""Near-duplicate chunk detection with SimHash fingerprints"""
+
+import sqlite3
+from contextlib import closing
+from hashlib import blake2b
+from time import sleep, time
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import numpy as np
+
+SHINGLE_WORDS = 3
+BANDS = 4
+BAND_BITS = 64 // BANDS
+POLL_SECONDS = 0.1
+
+
+def simhash(text: str) -> int:
+    """
+    This function computes the 64-bit SimHash of a text from its word shingles.
+    Texts sharing most of their shingles get fingerprints a few bits apart.
+    :param text: str
+    :return: int
+    """
+    words = text.lower().split()
+    if not words:
+        return 0
+    shingles = [' '.join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))]
+    digests = b''.join(blake2b(shingle.encode('utf-8'), digest_size=8).digest() for shingle in shingles)
+
+    # Every shingle votes +1/-1 on each of the 64 bits, the fingerprint keeps the majority
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(len(shingles), 8), axis=1)
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(shingles)
+    return int.from_bytes(np.packbits(votes > 0).tobytes(), 'big')
+
+
+def _to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class DedupIndex(object):
+    """
+    Persistent index of the chunk fingerprints of every collection. The 64 bits are
+    split into bands that are indexed separately: two fingerprints within fewer bits
+    than there are bands always share a band, so candidates are found with an index
+    lookup instead of a full scan. New chunks are reserved in the index until they are
+    stored, so that concurrent requests see them as duplicates; a reservation older
+    than `reservation_seconds` is assumed abandoned and ignored.
+    """
+
+    def __init__(self, db_path: str, max_distance: int = 3, reservation_seconds: float = 30):
+        if max_distance >= BANDS:
+            raise ValueError(f"The maximum Hamming distance must be lower than {BANDS}.")
+        self.db_path = db_path
+        self.max_distance = max_distance
+        self.reservation_seconds = reservation_seconds
+        with closing(self._connect()) as connection, connection:
+            band_columns = ', '.join(f"band{band} INTEGER" for band in range(BANDS))
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS fingerprints (collection TEXT, fingerprint INTEGER, point_id TEXT, "
+                f"url TEXT, {band_columns}, reservation TEXT, reserved REAL)"
+            )
+            for band in range(BANDS):
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS fingerprints_band{band} ON fingerprints (collection, band{band})"
+                )
+            connection.execute("CREATE INDEX IF NOT EXISTS fingerprints_reservation ON fingerprints (reservation)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_urls "
+                "(collection TEXT, point_id TEXT, url TEXT, PRIMARY KEY (collection, point_id, url))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS stats (collection TEXT PRIMARY KEY, chunks INTEGER, duplicates INTEGER)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    @staticmethod
+    def _bands(fingerprint: int) -> List[int]:
+        return [(fingerprint >> (band * BAND_BITS)) & ((1 << BAND_BITS) - 1) for band in range(BANDS)]
+
+    def _find(self, connection: sqlite3.Connection, collection_name: str,
+              fingerprint: int) -> Optional[Tuple[str, str, Optional[str]]]:
+        condition = ' OR '.join(f"band{band} = ?" for band in range(BANDS))
+        rows = connection.execute(
+            f"SELECT fingerprint, point_id, url, reservation FROM fingerprints WHERE collection = ? "
+            f"AND ({condition}) AND (reservation IS NULL OR reserved >= ?)",
+            [collection_name, *self._bands(fingerprint), time() - self.reservation_seconds]
+        ).fetchall()
+        for candidate, point_id, url, reservation in rows:
+            if bin((candidate & 0xFFFFFFFFFFFFFFFF) ^ fingerprint).count('1') <= self.max_distance:
+                return point_id, url, reservation
+        return None
+
+    def find(self, collection_name: str, fingerprint: int) -> Optional[Tuple[str, str]]:
+        """
+        Returns the (point id, url) of an indexed or reserved near duplicate of the fingerprint, if any.
+        :param collection_name: str
+        :param fingerprint: int
+        :return: tuple/None
+        """
+        with closing(self._connect()) as connection:
+            existing = self._find(connection, collection_name, fingerprint)
+        return existing[:2] if existing else None
+
+    def partition(self, collection_name: str, chunks: List[str],
+                  url: str) -> Tuple[List[Tuple[str, int, str]], List[Tuple[str, str, bool]], str]:
+        """
+        Splits chunks into the unique ones and the (point id, url, pending) of the indexed chunks
+        the others duplicate, pending when another request has reserved but not yet stored them.
+        Chunks repeated within the list are kept once and are not listed as duplicates. The unique
+        chunks are reserved under new point ids in the same transaction, and the reservation must
+        be committed once they are stored, or released.
+        :param collection_name: str
+        :param chunks: list
+        :param url: str, the URL the chunks come from
+        :return: tuple, ([(chunk, fingerprint, point id)], duplicates, reservation)
+        """
+        reservation = str(uuid4())
+        unique, duplicates = [], []
+        with closing(self._connect()) as connection, connection:
+            # Serializes the partitions, so two requests cannot both miss the same new chunk
+            connection.execute("BEGIN IMMEDIATE")
+            now = time()
+            connection.execute(
+                "DELETE FROM fingerprints WHERE reservation IS NOT NULL AND reserved < ?",
+                (now - self.reservation_seconds,)
+            )
+            for chunk in chunks:
+                fingerprint = simhash(chunk)
+                existing = self._find(connection, collection_name, fingerprint)
+                if existing is None:
+                    point_id = str(uuid4())
+                    self._insert(connection, collection_name, [(fingerprint, point_id, url)], reservation, now)
+                    unique.append((chunk, fingerprint, point_id))
+                elif existing[2] != reservation:
+                    point_id, point_url, existing_reservation = existing
+                    duplicates.append((point_id, point_url, existing_reservation is not None))
+        return unique, duplicates, reservation
+
+    def _insert(self, connection: sqlite3.Connection, collection_name: str, entries: List[Tuple[int, str, str]],
+                reservation: Optional[str] = None, reserved: Optional[float] = None):
+        connection.executemany(
+            f"INSERT INTO fingerprints VALUES (?, ?, ?, ?, {', '.join('?' * BANDS)}, ?, ?)",
+            [
+                (collection_name, _to_signed(fingerprint), point_id, url, *self._bands(fingerprint),
+                 reservation, reserved)
+                for fingerprint, point_id, url in entries
+            ]
+        )
+
+    def commit(self, reservation: str):
+        """
+        Turns the reserved fingerprints into indexed ones, once their chunks are stored.
+        :param reservation: str
+        """
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "UPDATE fingerprints SET reservation = NULL, reserved = NULL WHERE reservation = ?", (reservation,)
+            )
+
+    def release(self, reservation: str):
+        """
+        Drops the reserved fingerprints of chunks that were not stored.
+        :param reservation: str
+        """
+        with closing(self._connect()) as connection, connection:
+            connection.execute("DELETE FROM fingerprints WHERE reservation = ?", (reservation,))
+
+    def pending(self, collection_name: str, point_ids: List[str]) -> List[str]:
+        """
+        Returns the points that are still reserved by another request.
+        :param collection_name: str
+        :param point_ids: list
+        :return: list
+        """
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                f"SELECT point_id FROM fingerprints WHERE collection = ? AND reservation IS NOT NULL "
+                f"AND reserved >= ? AND point_id IN ({', '.join('?' * len(point_ids))})",
+                [collection_name, time() - self.reservation_seconds, *point_ids]
+            ).fetchall()
+        return [point_id for point_id, in rows]
+
+    def wait(self, collection_name: str, point_ids: List[str]):
+        """
+        Waits until the reservations of the points are committed, released or expired.
+        :param collection_name: str
+        :param point_ids: list
+        """
+        while self.pending(collection_name, point_ids):
+            sleep(POLL_SECONDS)
+
+    def add(self, collection_name: str, entries: List[Tuple[int, str, str]]):
+        """
+        Indexes the (fingerprint, point id, url) of stored chunks.
+        :param collection_name: str
+        :param entries: list
+        """
+        with closing(self._connect()) as connection, connection:
+            self._insert(connection, collection_name, entries)
+
+    def remove(self, collection_name: str, point_ids: List[str]):
+        """
+        Drops the fingerprints and URL references of points that are no longer stored.
+        :param collection_name: str
+        :param point_ids: list
+        """
+        with closing(self._connect()) as connection, connection:
+            for table in ('fingerprints', 'chunk_urls'):
+                connection.executemany(
+                    f"DELETE FROM {table} WHERE collection = ? AND point_id = ?",
+                    [(collection_name, point_id) for point_id in point_ids]
+                )
+
+    def reference(self, collection_name: str, references: List[Tuple[str, str]]):
+        """
+        Records that indexed chunks also appear on other URLs. The rows are insert-only,
+        so concurrent indexing requests cannot overwrite each other's references.
+        :param collection_name: str
+        :param references: list of (point id, url)
+        """
+        with closing(self._connect()) as connection, connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO chunk_urls VALUES (?, ?, ?)",
+                [(collection_name, point_id, url) for point_id, url in references]
+            )
+
+    def urls(self, collection_name: str, point_id: str) -> List[str]:
+        """
+        Returns the URLs, other than its own, a chunk has been found on.
+        :param collection_name: str
+        :param point_id: str
+        :return: list
+        """
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT url FROM chunk_urls WHERE collection = ? AND point_id = ? ORDER BY rowid",
+                (collection_name, point_id)
+            ).fetchall()
+        return [url for url, in rows]
+
+    def record(self, collection_name: str, chunks: int, duplicates: int):
+        """
+        Adds to the chunk and duplicate counters of a collection.
+        :param collection_name: str
+        :param chunks: int
+        :param duplicates: int
+        """
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "INSERT INTO stats VALUES (?, ?, ?) ON CONFLICT (collection) DO UPDATE SET "
+                "chunks = chunks + excluded.chunks, duplicates = duplicates + excluded.duplicates",
+                (collection_name, chunks, duplicates)
+            )
+
+    def stats(self, collection_name: str) -> Dict:
+        """
+        Returns the cumulative dedup counters of a collection.
+        :param collection_name: str
+        :return: dict
+        """
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                "SELECT chunks, duplicates FROM stats WHERE collection = ?", (collection_name,)
+            ).fetchone()
+        chunks, duplicates = row or (0, 0)
+        return dedup_rate(chunks, duplicates)
+
+    def clear(self, collection_name: str):
+        with closing(self._connect()) as connection, connection:
+            connection.execute("DELETE FROM fingerprints WHERE collection = ?", (collection_name,))
+            connection.execute("DELETE FROM chunk_urls WHERE collection = ?", (collection_name,))
+            connection.execute("DELETE FROM stats WHERE collection = ?", (collection_name,))
+
+
+def dedup_rate(chunks: int, duplicates: int) -> Dict:
+    return {
+        "chunks": chunks,
+        "duplicates": duplicates,
+        "dedup_rate": round(duplicates / chunks, 4) if chunks else 0.0
+    }
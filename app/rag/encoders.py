@@ -0,0 +1,138 @@
+"""Text encoders used to embed chunks and queries"""
+
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+import numpy as np
+
+from config import (ENCODER, EMBEDDING_MODEL_NAME, VECTOR_DIMENSION, HASHING_ENCODER_DIMENSION,
+                    HASHING_ENCODER_NGRAM_RANGE)
+
+OPENAI_BATCH_SIZE = 256
+
+
+class Encoder(ABC):
+    """
+    Base class of the text encoders. The name identifies the vector space
+    and is recorded in the collections built with the encoder.
+    """
+    name = None
+    dimension = None
+    # Whether a prefix of the vector is itself a usable embedding (Matryoshka training)
+    supports_truncation = False
+    # Whether encoding calls a remote service, which makes coalescing identical calls worthwhile
+    is_remote = False
+
+    @abstractmethod
+    def encode_batch(self, texts: List[str]) -> np.ndarray:
+        """
+        Encodes the texts into a (len(texts), dimension) float32 array.
+        :param texts: list
+        :return: array
+        """
+
+    def encode(self, text: str) -> np.ndarray:
+        return self.encode_batch([text])[0]
+
+    def check_vector_name(self, collection_name: str, vector_name: Optional[str]):
+        """
+        Rejects a collection whose full vector, named after the encoder that built it,
+        comes from another encoder. Collections with a single unnamed vector predate
+        encoders and were built with the OpenAI model.
+        :param collection_name: str
+        :param vector_name: str/None
+        """
+        collection_encoder = vector_name or EMBEDDING_MODEL_NAME
+        if collection_encoder != self.name:
+            raise ValueError(
+                f"Collection '{collection_name}' was built with encoder '{collection_encoder}', "
+                f"but the configured encoder is '{self.name}'."
+            )
+
+
+class OpenAIEncoder(Encoder):
+    """
+    Encoder calling the OpenAI embeddings API.
+    """
+    supports_truncation = True
+    is_remote = True
+
+    def __init__(self, client, model: str = EMBEDDING_MODEL_NAME, dimension: int = VECTOR_DIMENSION):
+        self.client = client
+        self.name = model
+        self.dimension = dimension
+
+    def encode_batch(self, texts: List[str]) -> np.ndarray:
+        embeddings = []
+        for start in range(0, len(texts), OPENAI_BATCH_SIZE):
+            response = self.client.embeddings.create(
+                input=texts[start:start + OPENAI_BATCH_SIZE],
+                model=self.name
+            )
+            embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        return np.asarray(embeddings, dtype=np.float32).reshape(len(texts), self.dimension)
+
+
+class HashingEncoder(Encoder):
+    """
+    CPU-only encoder hashing the character n-grams of a text into a fixed number
+    of signed buckets (the hashing trick). The n-gram hashes are rolling hashes
+    computed over the UTF-8 bytes with NumPy, so it runs in-process and offline.
+    """
+
+    def __init__(self, dimension: int = HASHING_ENCODER_DIMENSION, ngram_range: tuple = HASHING_ENCODER_NGRAM_RANGE):
+        self.dimension = dimension
+        self.ngram_range = tuple(ngram_range)
+        self.name = f"hashing-{dimension}-{self.ngram_range[0]}-{self.ngram_range[1]}"
+
+    def _hash_ngrams(self, text: str) -> np.ndarray:
+        padded = f" {' '.join(text.lower().split())} ".encode('utf-8')
+        data = np.frombuffer(padded, dtype=np.uint8).astype(np.uint32)
+        hashes = []
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            count = len(data) - n + 1
+            if count <= 0:
+                continue
+            # Polynomial hash of every n-gram at once, seeded with n so lengths do not collide
+            ngram_hash = np.full(count, n, dtype=np.uint32)
+            for offset in range(n):
+                ngram_hash = ngram_hash * np.uint32(16777619) + data[offset:offset + count]
+            hashes.append(ngram_hash)
+        if not hashes:
+            return np.empty(0, dtype=np.uint32)
+
+        # Murmur3 finalizer to spread the bits before taking buckets and signs
+        mixed = np.concatenate(hashes)
+        mixed ^= mixed >> np.uint32(16)
+        mixed *= np.uint32(0x85ebca6b)
+        mixed ^= mixed >> np.uint32(13)
+        mixed *= np.uint32(0xc2b2ae35)
+        mixed ^= mixed >> np.uint32(16)
+        return mixed
+
+    def encode_batch(self, texts: List[str]) -> np.ndarray:
+        hashes = [self._hash_ngrams(text) for text in texts]
+        rows = np.repeat(np.arange(len(texts), dtype=np.int64), [len(h) for h in hashes])
+        mixed = np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint32)
+
+        buckets = rows * self.dimension + (mixed % np.uint32(self.dimension)).astype(np.int64)
+        signs = np.where(mixed >> np.uint32(31), -1.0, 1.0)
+        vectors = np.bincount(buckets, weights=signs, minlength=len(texts) * self.dimension)
+        vectors = vectors.reshape(len(texts), self.dimension).astype(np.float32)
+
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+
+def get_encoder(openai_client=None, encoder_name: str = ENCODER) -> Encoder:
+    """
+    This function builds the encoder selected in the configuration.
+    :param openai_client: OpenAI
+    :param encoder_name: str
+    :return: Encoder
+    """
+    if encoder_name == 'openai':
+        return OpenAIEncoder(openai_client)
+    if encoder_name == 'hashing':
+        return HashingEncoder()
+    raise ValueError(f"Unknown encoder '{encoder_name}', expected 'openai' or 'hashing'.")
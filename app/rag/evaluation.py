@@ -0,0 +1,262 @@
+"""Offline evaluation of retrieval quality against latency and memory
+
+Usage:
+    python -m app.rag.evaluation labeled_queries.json configurations.json [--output report.json]
+
+labeled_queries.json is a list of queries with their relevant URLs and/or chunk snippets:
+    [{"query": "What is ColBERT?", "relevant_urls": ["https://..."], "relevant_chunks": ["late interaction"]}]
+
+configurations.json is a list of retrieval configurations to compare. Configurations can
+point to different collections, e.g. collections built with another chunking or search dimension:
+    [{"name": "baseline", "collection_name": "chatbot-rag-db-collection-v1", "limit": 5},
+     {"name": "ef-32", "collection_name": "chatbot-rag-db-collection-v1", "limit": 5, "hnsw_ef": 32},
+     {"name": "int8", "collection_name": "collection-int8", "limit": 5,
+      "quantization": {"rescore": true, "oversampling": 2.0}}]
+"""
+
+import argparse
+from json import dump, load
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+import numpy as np
+from qdrant_client.http.models import QuantizationSearchParams, SearchParams
+
+from app.rag.services import (check_collection_encoder, encode_text, get_vector_layout, qclient,
+                              search_embedding)
+from config import RESCORE_OVERSAMPLING
+
+HNSW_LINK_BYTES = 4
+
+
+def matched_targets(payload: Dict, relevant_urls: set, relevant_chunks: List[str]) -> set:
+    """
+    This function returns the relevance targets (urls and chunk snippets) matched by a hit.
+    :param payload: dict
+    :param relevant_urls: set
+    :param relevant_chunks: list
+    :return: set
+    """
+    matched = {('url', payload['url'])} if payload.get('url') in relevant_urls else set()
+    matched.update(('chunk', snippet) for snippet in relevant_chunks if snippet in payload.get('text', ''))
+    return matched
+
+
+def score_hits(payloads: List[Dict], relevant_urls: set, relevant_chunks: List[str]) -> Tuple[float, float]:
+    """
+    This function returns the recall and the reciprocal rank of the first relevant hit of a ranked
+    list of hit payloads. Recall counts the relevance targets (urls and chunk snippets) found.
+    :param payloads: list
+    :param relevant_urls: set
+    :param relevant_chunks: list
+    :return: tuple, (recall, reciprocal rank)
+    """
+    found, first_rank = set(), None
+    for rank, payload in enumerate(payloads, start=1):
+        matched = matched_targets(payload, relevant_urls, relevant_chunks)
+        if matched and first_rank is None:
+            first_rank = rank
+        found |= matched
+    return len(found) / (len(relevant_urls) + len(relevant_chunks)), 1 / first_rank if first_rank else 0.0
+
+
+def estimate_memory_footprint(collection_name: str) -> Dict:
+    """
+    This function estimates the RAM used by the vectors and HNSW links of a collection.
+    Vectors kept on disk only count through their quantized copy, if any.
+    :param collection_name: str
+    :return: dict
+    """
+    info = qclient.get_collection(collection_name)
+    points = qclient.count(collection_name)
+    vectors = info.config.params.vectors
+    vectors = vectors if isinstance(vectors, dict) else {'': vectors}
+
+    ram_bytes = 0
+    for params in vectors.values():
+        if not params.on_disk:
+            ram_bytes += points * params.size * 4
+
+        quantization = params.quantization_config or info.config.quantization_config
+        if quantization is not None:
+            if getattr(quantization, 'binary', None) is not None:
+                ram_bytes += points * -(-params.size // 8)
+            elif getattr(quantization, 'product', None) is not None:
+                ram_bytes += points * params.size * 4 // int(quantization.product.compression.value.lstrip('x'))
+            else:
+                ram_bytes += points * params.size
+
+        hnsw_m = params.hnsw_config.m if params.hnsw_config and params.hnsw_config.m is not None \
+            else info.config.hnsw_config.m
+        # Layer 0 of the graph holds up to 2 * m links per point and dominates the index size
+        ram_bytes += points * hnsw_m * 2 * HNSW_LINK_BYTES
+
+    return {"points": points, "ram_bytes": ram_bytes}
+
+
+def build_search_params(configuration: Dict) -> SearchParams:
+    quantization = configuration.get('quantization')
+    return SearchParams(
+        hnsw_ef=configuration.get('hnsw_ef'),
+        exact=configuration.get('exact', False),
+        quantization=QuantizationSearchParams(**quantization) if quantization else None
+    )
+
+
+def evaluate_configuration(configuration: Dict, labeled_queries: List[Dict], query_embeddings: List) -> Dict:
+    """
+    This function runs every labeled query against one retrieval configuration.
+    :param configuration: dict
+    :param labeled_queries: list
+    :param query_embeddings: list
+    :return: dict
+    """
+    collection_name = configuration['collection_name']
+    limit = configuration.get('limit', 5)
+    oversampling = configuration.get('oversampling', RESCORE_OVERSAMPLING)
+    search_params = build_search_params(configuration)
+    check_collection_encoder(collection_name)
+
+    def _search(query_embedding):
+        return search_embedding(query_embedding, collection_name, limit, search_params, oversampling)
+
+    # Warm up the caches so the first query does not pay for loading the collection
+    _search(query_embeddings[0])
+
+    recalls, reciprocal_ranks, latencies = [], [], []
+    for labeled_query, query_embedding in zip(labeled_queries, query_embeddings):
+        start = perf_counter()
+        hits = _search(query_embedding)
+        latencies.append((perf_counter() - start) * 1000)
+
+        recall, reciprocal_rank = score_hits(
+            [hit.payload for hit in hits],
+            set(labeled_query.get('relevant_urls', [])),
+            labeled_query.get('relevant_chunks', [])
+        )
+        recalls.append(recall)
+        reciprocal_ranks.append(reciprocal_rank)
+
+    _, truncated_name, truncated_dimension = get_vector_layout(collection_name)
+    return {
+        "name": configuration.get('name', collection_name),
+        "collection_name": collection_name,
+        "k": limit,
+        "search_dimension": truncated_dimension if truncated_name else None,
+        "recall_at_k": round(float(np.mean(recalls)), 4),
+        "mrr": round(float(np.mean(reciprocal_ranks)), 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        "latencies_ms": [round(latency, 2) for latency in latencies],
+        **estimate_memory_footprint(collection_name)
+    }
+
+
+def mark_pareto_front(results: List[Dict]) -> List[Dict]:
+    """
+    This function flags the results no other result beats on recall, MRR, p50 latency
+    and RAM at the same time.
+    :param results: list
+    :return: list
+    """
+    objectives = [
+        np.array([result['recall_at_k'], result['mrr'], -result['p50_ms'], -result['ram_bytes']])
+        for result in results
+    ]
+    for result, own in zip(results, objectives):
+        result['pareto'] = not any(
+            np.all(other >= own) and np.any(other > own) for other in objectives if other is not own
+        )
+    return results
+
+
+def format_table(results: List[Dict]) -> str:
+    columns = ['name', 'collection_name', 'search_dimension', 'recall', 'mrr', 'p50_ms', 'p95_ms', 'ram_mb', 'pareto']
+    rows = []
+    for result in sorted(results, key=lambda result: (not result['pareto'], result['p50_ms'])):
+        rows.append([
+            result['name'], result['collection_name'], result['search_dimension'] or '-',
+            f"{result['recall_at_k']:.4f} @{result['k']}", f"{result['mrr']:.4f}", f"{result['p50_ms']:.2f}",
+            f"{result['p95_ms']:.2f}", f"{result['ram_bytes'] / 2 ** 20:.1f}", '*' if result['pareto'] else ''
+        ])
+    widths = [max(len(str(value)) for value in column) for column in zip(columns, *rows)]
+    lines = ['  '.join(str(value).ljust(width) for value, width in zip(row, widths)) for row in [columns, *rows]]
+    lines.insert(1, '  '.join('-' * width for width in widths))
+    return '\n'.join(lines)
+
+
+def validate_inputs(labeled_queries, configurations):
+    """
+    This function rejects empty or malformed labeled queries and configurations.
+    :param labeled_queries: list
+    :param configurations: list
+    """
+    if not isinstance(labeled_queries, list) or not labeled_queries:
+        raise ValueError('The labeled queries must be a non-empty JSON list.')
+    for position, labeled_query in enumerate(labeled_queries):
+        if not isinstance(labeled_query, dict) or not isinstance(labeled_query.get('query'), str) \
+                or not labeled_query['query'].strip():
+            raise ValueError(f"Labeled query #{position} has no 'query' text.")
+        relevant_urls = labeled_query.get('relevant_urls', [])
+        relevant_chunks = labeled_query.get('relevant_chunks', [])
+        if not isinstance(relevant_urls, list) or not isinstance(relevant_chunks, list) \
+                or not relevant_urls + relevant_chunks:
+            # A query without targets would score a recall of 0 and drag every configuration down
+            raise ValueError(f"Labeled query #{position} needs a non-empty 'relevant_urls' or 'relevant_chunks' list.")
+
+    if not isinstance(configurations, list) or not configurations:
+        raise ValueError('The configurations must be a non-empty JSON list.')
+    for position, configuration in enumerate(configurations):
+        if not isinstance(configuration, dict) or not configuration.get('collection_name'):
+            raise ValueError(f"Configuration #{position} has no 'collection_name'.")
+
+
+def run_evaluation(labeled_queries: List[Dict], configurations: List[Dict]) -> List[Dict]:
+    """
+    This function evaluates every configuration on the labeled queries. Queries are
+    encoded once and the encoding latency is reported separately from the search.
+    :param labeled_queries: list
+    :param configurations: list
+    :return: list
+    """
+    validate_inputs(labeled_queries, configurations)
+    start = perf_counter()
+    query_embeddings = [encode_text(labeled_query['query']) for labeled_query in labeled_queries]
+    encode_ms = (perf_counter() - start) * 1000 / len(labeled_queries)
+
+    results = [
+        evaluate_configuration(configuration, labeled_queries, query_embeddings)
+        for configuration in configurations
+    ]
+    for result in results:
+        result['encode_ms'] = round(encode_ms, 2)
+    return mark_pareto_front(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate retrieval quality against latency and memory.')
+    parser.add_argument('labeled_queries', help='JSON file of queries with their relevant URLs/chunks')
+    parser.add_argument('configurations', help='JSON file of retrieval configurations')
+    parser.add_argument('--output', help='Write the full results, with per-query latencies, to this JSON file')
+    args = parser.parse_args()
+
+    with open(args.labeled_queries) as labeled_queries_file:
+        labeled_queries = load(labeled_queries_file)
+    with open(args.configurations) as configurations_file:
+        configurations = load(configurations_file)
+    try:
+        validate_inputs(labeled_queries, configurations)
+    except ValueError as err:
+        parser.error(str(err))
+
+    results = run_evaluation(labeled_queries, configurations)
+    print(format_table(results))
+    print(f"\nQuery encoding: {results[0]['encode_ms']:.2f} ms/query, * = Pareto optimal")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
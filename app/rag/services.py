@@ -1,62 +1,177 @@
 from uuid import uuid4
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Batch, VectorParams
+from collections import defaultdict
+from time import perf_counter
+from qdrant_client.http.models import Batch, VectorParams, HnswConfigDiff, Prefetch, SearchParams
 import nltk
+import numpy as np
 from json import loads
 from openai import OpenAI
 from firecrawl import FirecrawlApp
 from nltk.tokenize import sent_tokenize
 
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 
+from app.rag.dedup import DedupIndex, dedup_rate
+from app.rag.encoders import get_encoder
+from app.rag.sharding import open_sharded_client
 from app.utilities.logger import logger
-from config import (FIRECRAWL_API_KEY, EMBEDDING_MODEL_NAME, VECTOR_DIMENSION, VECTOR_DB_PATH, DEFAULT_COLLECTION_NAME,
-                    OPENAI_LLM_MODEL, PROMPT_REPHRASE_QUERY, PROMPT_GENERATE_ANSWER, OPENAI_API_KEY)
+from app.utilities.single_flight import single_flight
+from config import (FIRECRAWL_API_KEY, DEFAULT_COLLECTION_NAME,
+                    OPENAI_LLM_MODEL, PROMPT_REPHRASE_QUERY, PROMPT_GENERATE_ANSWER, OPENAI_API_KEY,
+                    VECTOR_DB_PATH, VECTOR_DB_SHARDS, VECTOR_DB_SHARD_ROUTING_KEY, VECTOR_DB_SHARD_MANIFEST,
+                    SEARCH_VECTOR_DIMENSION, RESCORE_OVERSAMPLING, DEDUP_ENABLED, DEDUP_INDEX_PATH,
+                    DEDUP_MAX_HAMMING_DISTANCE, DEDUP_RESERVATION_SECONDS)
 
 nltk.download('punkt_tab')
-qclient = QdrantClient(path=VECTOR_DB_PATH)
+qclient = open_sharded_client(VECTOR_DB_SHARDS, VECTOR_DB_SHARD_MANIFEST, VECTOR_DB_PATH, VECTOR_DB_SHARD_ROUTING_KEY)
 openai_client = OpenAI(api_key=OPENAI_API_KEY)
+encoder = get_encoder(openai_client)
+dedup_index = DedupIndex(
+    DEDUP_INDEX_PATH, DEDUP_MAX_HAMMING_DISTANCE, DEDUP_RESERVATION_SECONDS
+) if DEDUP_ENABLED else None
+
+# Cache of collection name -> (full vector name, truncated vector name, truncated dimension)
+vector_layouts = {}
+REPORT_BATCH_SIZE = 256
 
 def process_urls_for_indexing(urls: List, collection_name: str = DEFAULT_COLLECTION_NAME) -> Tuple:
     """
     This function takes care of all the steps required to insert data
-    from each URL into the vector database.
+    from each URL into the vector database. Near duplicates of indexed chunks are
+    not stored again, the indexed chunk is referenced by the new URL instead.
     :param urls: list
     :param collection_name: str
-    :return: tuple
+    :return: tuple, (indexed urls, failed urls, dedup stats of this run)
     """
     indexed_url, failed_url = [], []
+    total_chunks, total_duplicates = 0, 0
 
     # Iterating over the URLs list to scrape, chunk and store content in vector DB
     for url in urls:
         try:
-            # Scrape the url content
-            scrapped_data = scrape_content_from_url(url)
+            chunks_count, duplicates_count = index_url(url, collection_name)
+            total_chunks += chunks_count
+            total_duplicates += duplicates_count
+            indexed_url.append(url)
+        except Exception as err:
+            logger.error('Error while inserting url into the vector DB:', str(err))
+            failed_url.append(url)
+
+    return indexed_url, failed_url, dedup_rate(total_chunks, total_duplicates)
+
+
+@single_flight("index_url")
+def index_url(url: str, collection_name: str) -> Tuple[int, int]:
+    """
+    This function scrapes, chunks, embeds and stores the content of a URL. Concurrent requests
+    indexing the same URL into the same collection share one execution, so the page is
+    neither embedded nor stored twice.
+    :param url: str
+    :param collection_name: str
+    :return: tuple, (chunks, near duplicates that were not stored)
+    """
+    # Scrape the url content
+    scrapped_data = scrape_content_from_url(url)
+
+    # Convert scraped text into chunks
+    chunks = get_chunks(scrapped_data, chunk_sentences=10)
+
+    # Skip the chunks that are near duplicates of already indexed content
+    if dedup_index:
+        unique_chunks, duplicates, reservation = partition_indexed_chunks(collection_name, chunks, url)
+    else:
+        unique_chunks, duplicates, reservation = [(chunk, None, str(uuid4())) for chunk in chunks], [], None
 
-            # Convert scraped text into chunks
-            chunks = get_chunks(scrapped_data, chunk_sentences=10)
+    # Insert data into the vector DB.
+    payloads, ids = [], []
 
-            # Insert data into the vector DB.
-            payloads, ids, embeddings = [], [], []
+    for chunk, _, point_id in unique_chunks:
+        payloads.append({"text": chunk, "url": url})
+        ids.append(point_id)
 
-            for chunk in chunks:
-                payloads.append({"text": chunk, "url": url})
-                ids.append(str(uuid4()))
-                embeddings.append(encode_text(chunk))
+    try:
+        if unique_chunks:
+            embeddings = encode_texts([chunk for chunk, _, _ in unique_chunks])
 
             # Upsert data to Qdrant collection
             qclient.upsert(
                 collection_name=collection_name,
-                points=Batch(ids=ids, vectors=embeddings, payloads=payloads)
+                points=Batch(ids=ids, vectors=build_point_vectors(collection_name, embeddings), payloads=payloads)
             )
-            indexed_url.append(url)
-        except Exception as err:
-            logger.error('Error while inserting url into the vector DB:', str(err))
-            failed_url.append(url)
+    except Exception:
+        # Let the other requests store the reserved chunks
+        if reservation:
+            dedup_index.release(reservation)
+        raise
+
+    if dedup_index:
+        # Commit the fingerprints right away so a later failure cannot get the chunks stored twice
+        dedup_index.commit(reservation)
+        # Duplicates only count once their reference to the indexed chunk is written
+        dedup_index.reference(
+            collection_name,
+            [(point_id, url) for point_id, point_url in duplicates if point_url != url]
+        )
+        dedup_index.record(collection_name, len(chunks), len(chunks) - len(unique_chunks))
+
+    return len(chunks), len(chunks) - len(unique_chunks)
+
+
+def partition_indexed_chunks(collection_name: str, chunks: List, url: str) -> Tuple[List, List, str]:
+    """
+    This function splits chunks into the unique ones and the near duplicates of indexed chunks.
+    The unique chunks are reserved in the dedup index until they are stored, so concurrent
+    requests for pages sharing content do not both store it. Duplicates of chunks another
+    request has reserved wait for that request to store or release them, and duplicates of
+    points missing from the vector DB drop those stale fingerprints, as the dedup index is a
+    separate file that can outlive the points. The chunks are then partitioned again.
+    :param collection_name: str
+    :param chunks: list
+    :param url: str
+    :return: tuple, ([(chunk, fingerprint, point id)], [(point id, url of the point)], reservation)
+    """
+    while True:
+        unique_chunks, duplicates, reservation = dedup_index.partition(collection_name, chunks, url)
+        pending_point_ids = [point_id for point_id, _, pending in duplicates if pending]
+        try:
+            missing_point_ids = find_missing_points(
+                collection_name, [(point_id, point_url) for point_id, point_url, pending in duplicates if not pending]
+            )
+        except Exception:
+            dedup_index.release(reservation)
+            raise
+        if not pending_point_ids and not missing_point_ids:
+            return unique_chunks, [(point_id, point_url) for point_id, point_url, _ in duplicates], reservation
+
+        # Nothing is held while waiting, so two requests never wait on each other
+        dedup_index.release(reservation)
+        if missing_point_ids:
+            logger.info(f"Dropping {len(missing_point_ids)} stale fingerprint(s) of '{collection_name}'")
+            dedup_index.remove(collection_name, missing_point_ids)
+        if pending_point_ids:
+            dedup_index.wait(collection_name, pending_point_ids)
+
+
+def find_missing_points(collection_name: str, points: List[Tuple[str, str]]) -> List:
+    """
+    This function returns the ids of the points that are not stored in the vector DB.
+    :param collection_name: str
+    :param points: list of (point id, url of the point)
+    :return: list
+    """
+    point_ids_by_shard = defaultdict(set)
+    for point_id, point_url in points:
+        # The point lives on the shard of the URL it was first indexed from
+        point_ids_by_shard[qclient.shard_client(point_id, {"url": point_url})].add(point_id)
 
-    return indexed_url, failed_url
+    missing_point_ids = []
+    for shard, point_ids in point_ids_by_shard.items():
+        records = shard.retrieve(collection_name=collection_name, ids=list(point_ids), with_payload=False)
+        missing_point_ids.extend(point_ids - {str(record.id) for record in records})
+    return missing_point_ids
 
 
+@single_flight("scrape_content_from_url")
 def scrape_content_from_url(url: str) -> str:
     """
     This function scrape the content from a URL using Firecrawl API
@@ -112,23 +227,50 @@ def get_chunks(text: str, chunk_sentences: int = 10, overlap_chunk_sentences: in
         raise Exception(err)
 
 
-def create_collection(collection_name: str) -> bool:
+def create_collection(collection_name: str, search_dimension: int = SEARCH_VECTOR_DIMENSION) -> bool:
     """
-    This function creates a new collection in Qdrant vector DB.
+    This function creates a new collection in Qdrant vector DB. With a search dimension,
+    the collection also stores truncated vectors for the first-pass search, while the
+    full-precision vectors are kept on disk without an HNSW index and only used for rescoring.
     :param collection_name: str
+    :param search_dimension: int
     :return: bool
     """
     try:
         status = qclient.create_collection(
-            collection_name=collection_name,
-            vectors_config=VectorParams(size=VECTOR_DIMENSION, distance="Cosine")
+            collection_name=collection_name, vectors_config=build_vectors_config(search_dimension)
         )
+        vector_layouts.pop(collection_name, None)
+        if dedup_index:
+            dedup_index.clear(collection_name)
         return status
     except Exception as err:
         logger.error('Error while creating a new collection in vector DB:', str(err))
         raise Exception(err)
 
 
+def build_vectors_config(search_dimension: int = 0) -> Dict:
+    """
+    This function returns the vectors of a new collection. Vectors are named after the encoder,
+    which records the encoder the collection is built with. With a search dimension, the full
+    vectors are kept on disk without an HNSW index and a truncated vector is added for search.
+    :param search_dimension: int
+    :return: dict
+    """
+    if not search_dimension:
+        return {encoder.name: VectorParams(size=encoder.dimension, distance="Cosine")}
+    if not encoder.supports_truncation:
+        raise ValueError(f"Encoder '{encoder.name}' does not support truncated search vectors.")
+    if not 0 < search_dimension < encoder.dimension:
+        raise ValueError(f"Search dimension must be between 1 and {encoder.dimension - 1}.")
+    return {
+        encoder.name: VectorParams(
+            size=encoder.dimension, distance="Cosine", on_disk=True, hnsw_config=HnswConfigDiff(m=0)
+        ),
+        f"{encoder.name}-{search_dimension}": VectorParams(size=search_dimension, distance="Cosine")
+    }
+
+
 def fetch_all_records(collection_name: str = DEFAULT_COLLECTION_NAME, limit: int = 10) -> list:
     """
     Retrieve all records from a collection with an optional limit.
@@ -138,13 +280,20 @@ def fetch_all_records(collection_name: str = DEFAULT_COLLECTION_NAME, limit: int
     """
     try:
         points = qclient.scroll(collection_name=collection_name, limit=limit)
-        return [{"id": point.id, "payload": point.payload} for point in points[0]]
+        records = [{"id": point.id, "payload": point.payload} for point in points[0]]
+
+        # Other URLs the near-duplicate detection found the chunks on
+        if dedup_index:
+            for record in records:
+                record["duplicate_urls"] = dedup_index.urls(collection_name, str(record["id"]))
+        return records
 
     except Exception as err:
         logger.error('Error while fetching the records from vector DB:', str(err))
         raise Exception(err)
 
 
+@single_flight("generate_query_response")
 def generate_query_response(previous_chat: str, current_query: str) -> Tuple:
     """
     This function checks for relevant chunks in the db and generates the response.
@@ -162,12 +311,7 @@ def generate_query_response(previous_chat: str, current_query: str) -> Tuple:
             rephrased_query = current_query
 
         # Search the relevant chunks in the vector DB
-        query_embedding = encode_text(rephrased_query)
-        search_result = qclient.search(
-            collection_name=DEFAULT_COLLECTION_NAME,
-            query_vector=query_embedding,
-            limit=5
-        )
+        search_result = search_chunks(rephrased_query, DEFAULT_COLLECTION_NAME, limit=5)
 
         # if search_result[0].score < 0.3:
         #     return "I don't quite get that. I don't have this information.", []
@@ -192,6 +336,232 @@ def generate_query_response(previous_chat: str, current_query: str) -> Tuple:
         raise Exception(err)
 
 
+def get_dedup_stats(collection_name: str = DEFAULT_COLLECTION_NAME) -> Dict:
+    """
+    This function returns the cumulative near-duplicate stats of a collection.
+    :param collection_name: str
+    :return: dict
+    """
+    if not dedup_index:
+        raise ValueError('Near-duplicate detection is disabled.')
+    return dedup_index.stats(collection_name)
+
+
+def get_vector_layout(collection_name: str) -> Tuple[Optional[str], Optional[str], int]:
+    """
+    This function returns the names of the full and truncated vectors of a collection
+    along with the truncated dimension. Unnamed (single vector) collections give (None, None, 0).
+    The full vector name is the name of the encoder the collection was built with.
+    :param collection_name: str
+    :return: tuple
+    """
+    if collection_name not in vector_layouts:
+        vectors = qclient.get_collection(collection_name).config.params.vectors
+        if isinstance(vectors, dict):
+            names = sorted(vectors, key=lambda name: vectors[name].size, reverse=True)
+            truncated_name = names[1] if len(names) > 1 else None
+            truncated_dimension = vectors[truncated_name].size if truncated_name else 0
+            vector_layouts[collection_name] = (names[0], truncated_name, truncated_dimension)
+        else:
+            vector_layouts[collection_name] = (None, None, 0)
+    return vector_layouts[collection_name]
+
+
+def check_collection_encoder(collection_name: str):
+    """
+    This function rejects using the configured encoder on a collection built with another one.
+    :param collection_name: str
+    """
+    full_name, _, _ = get_vector_layout(collection_name)
+    encoder.check_vector_name(collection_name, full_name)
+
+
+def truncate_embeddings(embeddings, dimension: int) -> np.ndarray:
+    """
+    This function keeps the first `dimension` components of the embeddings and renormalizes
+    them, which is how text-embedding-3 models shorten vectors with the `dimensions` parameter.
+    :param embeddings: list/array
+    :param dimension: int
+    :return: array
+    """
+    truncated = np.asarray(embeddings, dtype=np.float32)[..., :dimension]
+    norms = np.linalg.norm(truncated, axis=-1, keepdims=True)
+    return truncated / np.where(norms == 0, 1, norms)
+
+
+def build_point_vectors(collection_name: str, embeddings: np.ndarray):
+    """
+    This function shapes full embeddings into the vectors expected by the collection.
+    :param collection_name: str
+    :param embeddings: array
+    :return: list/dict
+    """
+    check_collection_encoder(collection_name)
+    full_name, truncated_name, truncated_dimension = get_vector_layout(collection_name)
+    if full_name is None:
+        return embeddings.tolist()
+    vectors = {full_name: embeddings.tolist()}
+    if truncated_name:
+        vectors[truncated_name] = truncate_embeddings(embeddings, truncated_dimension).tolist()
+    return vectors
+
+
+def search_chunks(query: str, collection_name: str = DEFAULT_COLLECTION_NAME, limit: int = 5) -> List:
+    """
+    This function searches the chunks closest to the query.
+    :param query: str
+    :param collection_name: str
+    :param limit: int
+    :return: list
+    """
+    check_collection_encoder(collection_name)
+    return search_embedding(encode_text(query), collection_name, limit)
+
+
+def search_embedding(query_embedding: List, collection_name: str = DEFAULT_COLLECTION_NAME, limit: int = 5,
+                     search_params: Optional[SearchParams] = None, oversampling: int = RESCORE_OVERSAMPLING) -> List:
+    """
+    This function searches the chunks closest to a query embedding. Collections with truncated
+    vectors are searched in two stages: a first pass over the truncated vectors fetches
+    `limit * oversampling` candidates which are then rescored with the full vectors.
+    :param query_embedding: list
+    :param collection_name: str
+    :param limit: int
+    :param search_params: SearchParams, HNSW/quantization params of the (first pass) search
+    :param oversampling: int
+    :return: list
+    """
+    try:
+        full_name, truncated_name, truncated_dimension = get_vector_layout(collection_name)
+
+        if truncated_name is None:
+            return qclient.search(
+                collection_name=collection_name,
+                query_vector=(full_name, query_embedding) if full_name else query_embedding,
+                search_params=search_params,
+                limit=limit
+            )
+
+        return qclient.query_points(
+            collection_name=collection_name,
+            prefetch=Prefetch(
+                query=truncate_embeddings(query_embedding, truncated_dimension).tolist(),
+                using=truncated_name,
+                params=search_params,
+                limit=limit * oversampling
+            ),
+            query=query_embedding,
+            using=full_name,
+            limit=limit
+        )
+    except Exception as err:
+        logger.error('Error while searching the chunks in vector DB:', str(err))
+        raise Exception(err)
+
+
+def report_search_dimensions(collection_name: str = DEFAULT_COLLECTION_NAME, dimensions: List = (256, 512),
+                             limit: int = 5, sample_size: int = 100, max_points: int = 10000) -> Dict:
+    """
+    This function measures the recall and latency of two-stage search for candidate dimensions.
+    Up to `max_points` stored full-precision vectors of a collection are copied into temporary
+    collections, one with the full vectors only and one per dimension with the two-stage layout,
+    and a sample of them is searched as queries through `search_embedding`, the production search
+    path. The exact full-dimension top-k is the ground truth.
+    :param collection_name: str
+    :param dimensions: list
+    :param limit: int
+    :param sample_size: int
+    :param max_points: int
+    :return: dict
+    """
+    try:
+        check_collection_encoder(collection_name)
+        if not encoder.supports_truncation:
+            raise ValueError(f"Encoder '{encoder.name}' does not support truncated search vectors.")
+
+        full_name, _, _ = get_vector_layout(collection_name)
+        records, next_offset = qclient.scroll(
+            collection_name=collection_name,
+            limit=max_points,
+            with_payload=False,
+            with_vectors=[full_name] if full_name else True
+        )
+        vectors = np.asarray(
+            [record.vector[full_name] if full_name else record.vector for record in records], dtype=np.float32
+        )
+        if len(vectors) <= limit:
+            raise ValueError(f"Collection '{collection_name}' needs more than {limit} points for the report.")
+        invalid_dimensions = [dimension for dimension in dimensions if not 0 < dimension < vectors.shape[1]]
+        if invalid_dimensions:
+            raise ValueError(
+                f"Dimensions {invalid_dimensions} must be between 1 and {vectors.shape[1] - 1}, "
+                f"the size of the stored vectors."
+            )
+        if next_offset is not None:
+            logger.info(f"Search dimension report of '{collection_name}' limited to its first {max_points} points")
+
+        point_ids = [str(record.id) for record in records]
+        sample = np.random.default_rng(0).choice(len(vectors), size=min(sample_size, len(vectors)), replace=False)
+        normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        scores = normalized[sample] @ normalized.T
+        # Queries are stored points themselves, so they must not match themselves
+        scores[np.arange(len(sample)), sample] = -np.inf
+        exact = np.argpartition(-scores, limit, axis=1)[:, :limit]
+
+        def _measure(search_dimension: int) -> Tuple[float, float]:
+            temporary_name = f"{collection_name}-report-{uuid4().hex}"
+            try:
+                qclient.create_collection(
+                    collection_name=temporary_name, vectors_config=build_vectors_config(search_dimension)
+                )
+                for start in range(0, len(vectors), REPORT_BATCH_SIZE):
+                    qclient.upsert(
+                        collection_name=temporary_name,
+                        points=Batch(
+                            ids=point_ids[start:start + REPORT_BATCH_SIZE],
+                            vectors=build_point_vectors(temporary_name, vectors[start:start + REPORT_BATCH_SIZE])
+                        )
+                    )
+
+                # Warm up the collection so the first query does not pay for loading it
+                search_embedding(vectors[sample[0]].tolist(), temporary_name, limit + 1)
+                hits, latencies = 0, []
+                for query, neighbours in zip(sample, exact):
+                    start = perf_counter()
+                    results = search_embedding(vectors[query].tolist(), temporary_name, limit + 1)
+                    latencies.append((perf_counter() - start) * 1000)
+                    found = [str(point.id) for point in results if str(point.id) != point_ids[query]][:limit]
+                    hits += len(set(found) & {point_ids[neighbour] for neighbour in neighbours})
+                return hits / (len(sample) * limit), float(np.percentile(latencies, 50))
+            finally:
+                qclient.delete_collection(temporary_name)
+                vector_layouts.pop(temporary_name, None)
+
+        full_recall, full_ms = _measure(0)
+        report = {
+            "points": len(vectors),
+            "sample_truncated": next_offset is not None,
+            "queries": len(sample),
+            "full_recall_at_k": round(full_recall, 4),
+            "full_p50_ms": round(full_ms, 3),
+            "dimensions": []
+        }
+        for dimension in dimensions:
+            recall, two_stage_ms = _measure(dimension)
+            report["dimensions"].append({
+                "dimension": dimension,
+                "recall_at_k": round(recall, 4),
+                "p50_ms": round(two_stage_ms, 3),
+                "speedup": round(full_ms / two_stage_ms, 2),
+                "memory_ratio": round(dimension / vectors.shape[1], 4)
+            })
+
+        return report
+    except Exception as err:
+        logger.error('Error while reporting the search dimensions:', str(err))
+        raise Exception(err)
+
+
 def generate_query_for_searching(previous_chat: str, current_query: str) -> str:
     """
     This function calls a LLM to generate the relevant query based on the context.
@@ -257,19 +627,29 @@ def generate_response_from_context(context: str, current_query: str) -> Tuple:
         raise Exception(err)
 
 
+# In-process encoders are faster than the SQLite round trips of coalescing
+@single_flight(f"encode_text:{encoder.name}", enabled=encoder.is_remote)
 def encode_text(text: str) -> List:
     """
-    This function uses openai text embeddings to convert a text into the vectors.
+    This function uses the configured encoder to convert a text into the vectors.
     :param text: str
     :return: list
     """
     try:
-        response = openai_client.embeddings.create(
-            input=text,
-            model=EMBEDDING_MODEL_NAME
-        )
+        return encoder.encode(text).tolist()
+    except Exception as err:
+        logger.error('Error while generating the text embeddings:', str(err))
+        raise Exception(err)
+
 
-        return response.data[0].embedding
+def encode_texts(texts: List) -> np.ndarray:
+    """
+    This function uses the configured encoder to convert a batch of texts into the vectors.
+    :param texts: list
+    :return: array
+    """
+    try:
+        return encoder.encode_batch(texts)
     except Exception as err:
         logger.error('Error while generating the text embeddings:', str(err))
-        raise Exception(err)
\ No newline at end of file
+        raise Exception(err)
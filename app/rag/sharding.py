@@ -0,0 +1,346 @@
+"""Sharded Qdrant collections with parallel fan-out search
+
+Usage, after changing VECTOR_DB_SHARDS and before starting the app:
+    python -m app.rag.sharding
+"""
+
+import argparse
+import heapq
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from itertools import chain
+from json import dump, load
+from operator import attrgetter
+from os import path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import Batch, PointIdsList, PointStruct
+
+from app.utilities.logger import logger
+from config import VECTOR_DB_PATH, VECTOR_DB_SHARDS, VECTOR_DB_SHARD_MANIFEST, VECTOR_DB_SHARD_ROUTING_KEY
+
+REBALANCE_BATCH_SIZE = 256
+
+
+def connect_client(location: str) -> QdrantClient:
+    """
+    This function opens a Qdrant client for a shard location, which is
+    either a Qdrant server URL or a local storage path.
+    :param location: str
+    :return: QdrantClient
+    """
+    if location.startswith(('http://', 'https://')):
+        return QdrantClient(url=location)
+    return QdrantClient(path=location)
+
+
+def jump_hash(key: int, num_buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping & Veach). Growing from N to N+1 buckets
+    only moves 1/(N+1) of the keys, all of them to the new bucket.
+    :param key: int
+    :param num_buckets: int
+    :return: int
+    """
+    bucket, candidate = -1, 0
+    while candidate < num_buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+class ShardedQdrant(object):
+    """
+    Routes points of every collection to one of N Qdrant shards by hash of the
+    point id or of its URL, and fans searches out to all shards concurrently.
+    The methods mirror the subset of the QdrantClient API used by the services.
+    """
+
+    def __init__(self, locations: List[str], routing_key: str = 'url'):
+        if not locations:
+            raise ValueError('At least one shard location is required.')
+        if routing_key not in ('url', 'id'):
+            raise ValueError(f"Unknown shard routing key '{routing_key}', expected 'url' or 'id'.")
+        self.routing_key = routing_key
+        self._attach([connect_client(location) for location in locations], list(locations))
+
+    def _attach(self, clients: List[QdrantClient], locations: List[str]):
+        self.clients = clients
+        self.locations = locations
+        self.executor = ThreadPoolExecutor(max_workers=len(clients), thread_name_prefix='qdrant-shard')
+
+    def shard_for(self, point_id: Any, payload: Optional[Dict] = None, num_shards: Optional[int] = None) -> int:
+        """
+        Returns the index of the shard owning a point.
+        :param point_id: str/int
+        :param payload: dict
+        :param num_shards: int
+        :return: int
+        """
+        num_shards = num_shards or len(self.clients)
+        key = payload.get('url') if self.routing_key == 'url' and payload else None
+        if key is None:
+            key = point_id
+        digest = blake2b(str(key).encode('utf-8'), digest_size=8).digest()
+        return jump_hash(int.from_bytes(digest, 'big'), num_shards)
+
+    def shard_client(self, point_id: Any, payload: Optional[Dict] = None) -> QdrantClient:
+        """
+        Returns the client of the shard owning a point, for point level operations.
+        :param point_id: str/int
+        :param payload: dict
+        :return: QdrantClient
+        """
+        return self.clients[self.shard_for(point_id, payload)]
+
+    def _fan_out(self, function: Callable, items: Iterable) -> List:
+        return list(self.executor.map(function, items))
+
+    def create_collection(self, collection_name: str, **kwargs) -> bool:
+        results = self._fan_out(
+            lambda client: client.create_collection(collection_name=collection_name, **kwargs),
+            self.clients
+        )
+        return all(results)
+
+    def delete_collection(self, collection_name: str) -> bool:
+        results = self._fan_out(lambda client: client.delete_collection(collection_name=collection_name), self.clients)
+        return all(results)
+
+    def get_collection(self, collection_name: str):
+        # Every shard shares the same collection config, the first one is representative
+        return self.clients[0].get_collection(collection_name)
+
+    def count(self, collection_name: str) -> int:
+        results = self._fan_out(lambda client: client.count(collection_name=collection_name).count, self.clients)
+        return sum(results)
+
+    def upsert(self, collection_name: str, points: Batch, **kwargs) -> bool:
+        """
+        Splits a batch by owning shard and upserts the parts concurrently.
+        :param collection_name: str
+        :param points: Batch
+        :return: bool
+        """
+        positions_by_shard = defaultdict(list)
+        payloads = points.payloads or [None] * len(points.ids)
+        for position, (point_id, payload) in enumerate(zip(points.ids, payloads)):
+            positions_by_shard[self.shard_for(point_id, payload)].append(position)
+
+        def _upsert(item: Tuple[int, List[int]]):
+            shard, positions = item
+            if isinstance(points.vectors, dict):
+                vectors = {name: [values[i] for i in positions] for name, values in points.vectors.items()}
+            else:
+                vectors = [points.vectors[i] for i in positions]
+            batch = Batch(
+                ids=[points.ids[i] for i in positions],
+                vectors=vectors,
+                payloads=[payloads[i] for i in positions] if points.payloads else None
+            )
+            return self.clients[shard].upsert(collection_name=collection_name, points=batch, **kwargs)
+
+        self._fan_out(_upsert, positions_by_shard.items())
+        return True
+
+    def search(self, collection_name: str, limit: int = 10, **kwargs) -> List:
+        """
+        Searches every shard concurrently and heap-merges the global top-k.
+        :param collection_name: str
+        :param limit: int
+        :return: list
+        """
+        results = self._fan_out(
+            lambda client: client.search(collection_name=collection_name, limit=limit, **kwargs),
+            self.clients
+        )
+        return heapq.nlargest(limit, chain.from_iterable(results), key=attrgetter('score'))
+
+    def query_points(self, collection_name: str, limit: int = 10, **kwargs) -> List:
+        """
+        Runs a (prefetch + rescore) query on every shard concurrently and
+        heap-merges the global top-k.
+        :param collection_name: str
+        :param limit: int
+        :return: list
+        """
+        results = self._fan_out(
+            lambda client: client.query_points(collection_name=collection_name, limit=limit, **kwargs).points,
+            self.clients
+        )
+        return heapq.nlargest(limit, chain.from_iterable(results), key=attrgetter('score'))
+
+    def scroll(self, collection_name: str, limit: int = 10, offset: Optional[Tuple[int, Any]] = None,
+               **kwargs) -> Tuple[List, Optional[Tuple[int, Any]]]:
+        """
+        Collects up to `limit` records, draining the shards in order. The offset is the
+        (shard index, shard offset) cursor returned by the previous call, None once
+        every shard is drained.
+        :param collection_name: str
+        :param limit: int
+        :param offset: tuple
+        :return: tuple
+        """
+        shard, shard_offset = offset or (0, None)
+        records = []
+        while shard < len(self.clients) and len(records) < limit:
+            shard_records, shard_offset = self.clients[shard].scroll(
+                collection_name=collection_name, limit=limit - len(records), offset=shard_offset, **kwargs
+            )
+            records.extend(shard_records)
+            if shard_offset is None:
+                shard += 1
+        return records, (shard, shard_offset) if shard < len(self.clients) else None
+
+    def rebalance(self, locations: List[str]) -> int:
+        """
+        Moves every point of every collection to the shard that owns it under
+        the new list of locations, then switches the router over to them.
+        :param locations: list
+        :return: int, the number of moved points
+        """
+        clients_by_location = dict(zip(self.locations, self.clients))
+        new_clients = [clients_by_location.get(location) or connect_client(location) for location in locations]
+        collection_names = {
+            collection.name
+            for client in self.clients
+            for collection in client.get_collections().collections
+        }
+
+        moved = 0
+        for collection_name in collection_names:
+            sources = [client for client in self.clients if client.collection_exists(collection_name)]
+            vectors_config = sources[0].get_collection(collection_name).config.params.vectors
+            for client in new_clients:
+                if not client.collection_exists(collection_name):
+                    client.create_collection(collection_name=collection_name, vectors_config=vectors_config)
+
+            for source in sources:
+                offset = None
+                while True:
+                    records, offset = source.scroll(
+                        collection_name=collection_name,
+                        limit=REBALANCE_BATCH_SIZE,
+                        offset=offset,
+                        with_payload=True,
+                        with_vectors=True
+                    )
+                    points_by_target = defaultdict(list)
+                    for record in records:
+                        target = new_clients[self.shard_for(record.id, record.payload, len(new_clients))]
+                        if target is not source:
+                            points_by_target[id(target)].append(record)
+
+                    for target in new_clients:
+                        target_records = points_by_target.get(id(target))
+                        if not target_records:
+                            continue
+                        target.upsert(
+                            collection_name=collection_name,
+                            points=[PointStruct(id=r.id, vector=r.vector, payload=r.payload) for r in target_records]
+                        )
+                        source.delete(
+                            collection_name=collection_name,
+                            points_selector=PointIdsList(points=[r.id for r in target_records])
+                        )
+                        moved += len(target_records)
+
+                    if offset is None:
+                        break
+
+        retired = [client for client in self.clients if not any(client is new for new in new_clients)]
+        self.executor.shutdown(wait=True)
+        self._attach(new_clients, list(locations))
+        for client in retired:
+            client.close()
+
+        logger.info(f"Rebalanced {moved} points onto {len(new_clients)} shard(s)")
+        return moved
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for client in self.clients:
+            client.close()
+
+
+def read_shard_layout(manifest_path: str, legacy_location: str, routing_key: str) -> List[str]:
+    """
+    This function returns the shard locations recorded in the manifest. Without a
+    manifest, the data predates sharding and lives in the single legacy location.
+    :param manifest_path: str
+    :param legacy_location: str
+    :param routing_key: str
+    :return: list
+    """
+    manifest = {}
+    if path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = load(manifest_file)
+
+    if manifest.get('routing_key', routing_key) != routing_key:
+        raise ValueError(
+            f"Shards were built with routing key '{manifest['routing_key']}', "
+            f"changing it to '{routing_key}' is not supported."
+        )
+    return manifest.get('shards') or [legacy_location]
+
+
+def open_sharded_client(locations: List[str], manifest_path: str, legacy_location: str,
+                        routing_key: str = 'url') -> ShardedQdrant:
+    """
+    This function opens the configured shards. It never moves data: when they differ
+    from the recorded layout, the shards must first be rebalanced with
+    `python -m app.rag.sharding`.
+    :param locations: list
+    :param manifest_path: str
+    :param legacy_location: str
+    :param routing_key: str
+    :return: ShardedQdrant
+    """
+    previous_locations = read_shard_layout(manifest_path, legacy_location, routing_key)
+    if previous_locations != locations:
+        raise ValueError(
+            f"The configured shards {locations} differ from the recorded layout {previous_locations}, "
+            f"run `python -m app.rag.sharding` to rebalance them first."
+        )
+    return ShardedQdrant(locations, routing_key=routing_key)
+
+
+def rebalance_shards(locations: List[str], manifest_path: str, legacy_location: str,
+                     routing_key: str = 'url') -> int:
+    """
+    This function moves the data from the recorded shard layout onto the configured
+    locations and records them as the new layout.
+    :param locations: list
+    :param manifest_path: str
+    :param legacy_location: str
+    :param routing_key: str
+    :return: int, the number of moved points
+    """
+    previous_locations = read_shard_layout(manifest_path, legacy_location, routing_key)
+    moved = 0
+    if previous_locations != locations:
+        logger.info(f"Shard layout changed from {previous_locations} to {locations}, rebalancing")
+        client = ShardedQdrant(previous_locations, routing_key=routing_key)
+        try:
+            moved = client.rebalance(locations)
+        finally:
+            client.close()
+
+    with open(manifest_path, 'w') as manifest_file:
+        dump({'shards': locations, 'routing_key': routing_key}, manifest_file)
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebalance the vector DB onto the configured VECTOR_DB_SHARDS.')
+    parser.parse_args()
+    moved = rebalance_shards(VECTOR_DB_SHARDS, VECTOR_DB_SHARD_MANIFEST, VECTOR_DB_PATH, VECTOR_DB_SHARD_ROUTING_KEY)
+    print(f"{len(VECTOR_DB_SHARDS)} shard(s) ready, {moved} point(s) moved")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""Single-flight coalescing of identical in-flight calls"""
+
+import sqlite3
+import threading
+from contextlib import closing
+from functools import wraps
+from hashlib import sha256
+from json import dumps, loads
+from os import getpid
+from time import sleep, time
+from typing import Any, Callable, Dict, Optional
+from uuid import uuid4
+
+from app.utilities.logger import logger
+from config import (SINGLE_FLIGHT_ENABLED, SINGLE_FLIGHT_DB_PATH, SINGLE_FLIGHT_LEASE_SECONDS,
+                    SINGLE_FLIGHT_RESULT_TTL, SINGLE_FLIGHT_WAIT_SECONDS)
+
+POLL_SECONDS = 0.05
+COUNTERS = ('executions', 'shared_threads', 'shared_workers', 'wait_timeouts')
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Makes concurrent calls with the same key share one execution. Threads of a
+    process wait on the leader thread, and when a database path is given, the
+    processes (gunicorn workers) elect a leader through a lease row in SQLite
+    and read its result. Results must be JSON serializable: they are stored as
+    JSON, which unlike pickle cannot run code planted in the database file. A
+    result stays shareable for `result_ttl` seconds after it completes, and a
+    lease older than `lease_seconds` is taken over, in case its worker died. A caller waiting on another one for
+    more than `wait_seconds` gives up and runs the call itself, so that a slow
+    leader cannot hold its followers past the worker timeout.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, lease_seconds: float = 45, result_ttl: float = 2,
+                 wait_seconds: float = 20):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.result_ttl = result_ttl
+        self.wait_seconds = wait_seconds
+        self._owner = None
+        self._owner_pid = None
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.counters = {}
+        # The database is only created on first use, importing the app leaves no file behind
+        self.is_db_ready = False
+
+    @property
+    def owner(self) -> str:
+        # Workers forked from a preloaded app inherit this object, each needs its own lease owner id
+        pid = getpid()
+        if self._owner_pid != pid:
+            self._owner, self._owner_pid = f"{pid}-{uuid4()}", pid
+        return self._owner
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        if not self.is_db_ready:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS calls (key TEXT PRIMARY KEY, owner TEXT, started REAL, "
+                "finished REAL, result TEXT, error TEXT)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT, counter TEXT, value INTEGER, "
+                "PRIMARY KEY (name, counter))"
+            )
+            self.is_db_ready = True
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _count(self, name: str, counter: str):
+        if not self.db_path:
+            with self.lock:
+                counts = self.counters.setdefault(name, dict.fromkeys(COUNTERS, 0))
+                counts[counter] += 1
+            return
+        with closing(self._connect()) as connection:
+            connection.execute(
+                "INSERT INTO counters VALUES (?, ?, 1) ON CONFLICT (name, counter) DO UPDATE SET value = value + 1",
+                (name, counter)
+            )
+
+    def stats(self) -> Dict:
+        """
+        Returns the executions and the calls that shared them, per coalesced function.
+        :return: dict
+        """
+        if not self.db_path:
+            with self.lock:
+                stats = {name: dict(counts) for name, counts in self.counters.items()}
+        else:
+            stats = {}
+            with closing(self._connect()) as connection:
+                for name, counter, value in connection.execute("SELECT name, counter, value FROM counters"):
+                    stats.setdefault(name, dict.fromkeys(COUNTERS, 0))[counter] = value
+        for counts in stats.values():
+            counts['saved'] = counts['shared_threads'] + counts['shared_workers']
+        return stats
+
+    def call(self, name: str, key: str, function: Callable, *args, **kwargs) -> Any:
+        """
+        Runs `function`, unless an identical call is in flight, in which case its result is shared.
+        :param name: str
+        :param key: str
+        :param function: callable
+        :return: any
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = _Call()
+
+        if not is_leader:
+            if not call.event.wait(self.wait_seconds):
+                self._count(name, 'wait_timeouts')
+                return function(*args, **kwargs)
+            self._count(name, 'shared_threads')
+        else:
+            try:
+                call.result = self._call_across_workers(name, key, function, args, kwargs)
+            except Exception as err:
+                call.error = err
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.event.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _claim(self, connection: sqlite3.Connection, key: str) -> Optional[tuple]:
+        """
+        Takes the lease of a key, unless another worker holds a live lease or a fresh
+        result, in which case that row is returned.
+        """
+        now = time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT owner, started, finished, result, error FROM calls WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                _, started, finished, _, _ = row
+                is_live = now - started < self.lease_seconds if finished is None else now - finished < self.result_ttl
+                if is_live:
+                    return row
+            connection.execute(
+                "INSERT OR REPLACE INTO calls VALUES (?, ?, ?, NULL, NULL, NULL)", (key, self.owner, now)
+            )
+            return None
+        finally:
+            connection.execute("COMMIT")
+
+    def _call_across_workers(self, name: str, key: str, function: Callable, args: tuple, kwargs: dict) -> Any:
+        if not self.db_path:
+            self._count(name, 'executions')
+            return function(*args, **kwargs)
+
+        with closing(self._connect()) as connection:
+            deadline = time() + self.wait_seconds
+            row = self._claim(connection, key)
+            while row is not None:
+                owner, started, finished, result, error = row
+                if finished is not None:
+                    self._count(name, 'shared_workers')
+                    if error is not None:
+                        raise Exception(error)
+                    return loads(result)
+
+                if time() >= deadline:
+                    # Run the call without publishing it, the lease stays with the slow worker
+                    self._count(name, 'wait_timeouts')
+                    return function(*args, **kwargs)
+
+                # Another worker is running the call, wait for its result or for its lease to expire
+                sleep(POLL_SECONDS)
+                row = connection.execute(
+                    "SELECT owner, started, finished, result, error FROM calls WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None or row[0] != owner or (row[2] is None and time() - row[1] >= self.lease_seconds):
+                    row = self._claim(connection, key)
+
+            self._count(name, 'executions')
+            try:
+                result = function(*args, **kwargs)
+                encoded_result = dumps(result)
+            except Exception as err:
+                connection.execute(
+                    "UPDATE calls SET finished = ?, error = ? WHERE key = ? AND owner = ?",
+                    (time(), str(err), key, self.owner)
+                )
+                raise
+            connection.execute(
+                "UPDATE calls SET finished = ?, result = ? WHERE key = ? AND owner = ?",
+                (time(), encoded_result, key, self.owner)
+            )
+            connection.execute(
+                "DELETE FROM calls WHERE finished IS NOT NULL AND finished < ?", (time() - self.result_ttl,)
+            )
+            return result
+
+
+single_flight_group = SingleFlight(
+    SINGLE_FLIGHT_DB_PATH, SINGLE_FLIGHT_LEASE_SECONDS, SINGLE_FLIGHT_RESULT_TTL, SINGLE_FLIGHT_WAIT_SECONDS
+) if SINGLE_FLIGHT_ENABLED else None
+
+
+def single_flight(name: str, enabled: bool = True):
+    """
+    Decorator coalescing concurrent calls of a function made with the same arguments.
+    :param name: str, identifies the function in the keys and counters
+    :param enabled: bool, False for calls cheaper than the coordination itself
+    """
+    def decorator(function: Callable):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if single_flight_group is None or not enabled:
+                return function(*args, **kwargs)
+            key = sha256(repr((name, args, sorted(kwargs.items()))).encode('utf-8')).hexdigest()
+            return single_flight_group.call(name, key, function, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_single_flight_stats() -> Dict:
+    if single_flight_group is None:
+        logger.info('Single-flight coalescing is disabled.')
+        return {}
+    return single_flight_group.stats()
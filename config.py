@@ -20,11 +20,47 @@ FIRECRAWL_API_KEY = getenv('FIRECRAWL_API_KEY')
 OPENAI_API_KEY = getenv('OPENAI_API_KEY')
 SECRET_KEY = getenv('SECRET_KEY')
 
+# Text encoder: 'openai' calls the embeddings API with EMBEDDING_MODEL_NAME, 'hashing' is a CPU-only
+# hashed character n-gram vectorizer running in-process and offline. Collections record the encoder
+# they were built with and reject vectors from any other encoder.
+ENCODER = getenv('ENCODER', 'openai')
+HASHING_ENCODER_DIMENSION = 1024
+HASHING_ENCODER_NGRAM_RANGE = (3, 5)
 EMBEDDING_MODEL_NAME = "text-embedding-3-small"
+# Near-duplicate chunk detection: chunks whose 64-bit SimHash is within DEDUP_MAX_HAMMING_DISTANCE bits (at most 3)
+# of an already indexed chunk are not embedded or stored again, the indexed chunk is referenced by the new URL instead.
+DEDUP_ENABLED = getenv('DEDUP_ENABLED', 'true').lower() == 'true'
+DEDUP_INDEX_PATH = getenv('DEDUP_INDEX_PATH', "chatbot-rag-db-dedup.sqlite3")
+DEDUP_MAX_HAMMING_DISTANCE = 3
+# New chunks are reserved in the dedup index while they are embedded and stored, so concurrent requests do not
+# store them twice. A reservation older than DEDUP_RESERVATION_SECONDS is assumed abandoned.
+DEDUP_RESERVATION_SECONDS = 30
 OPENAI_LLM_MODEL = "gpt-4o-mini"
 VECTOR_DIMENSION = 1536
-VECTOR_DB_PATH = "chatbot-rag-db"
+# Reduced-dimension first-pass search: new collections also store the embeddings truncated and renormalized
+# to this many dimensions (0 disables it). Search runs on the truncated vectors and rescores the top
+# `limit * RESCORE_OVERSAMPLING` candidates against the full-precision vectors, which are kept on disk.
+SEARCH_VECTOR_DIMENSION = int(getenv('SEARCH_VECTOR_DIMENSION', 0))
+RESCORE_OVERSAMPLING = 4
+VECTOR_DB_PATH = getenv('VECTOR_DB_PATH', "chatbot-rag-db")
+# Sharded collection mode: a comma separated list of local paths or Qdrant URLs (http(s)://host:port).
+# Points are routed by consistent hash of their 'url' or 'id', so shards should only be appended to or
+# removed from the end of the list. After changing the list, rebalance the data with `python -m app.rag.sharding`
+# before starting the app, which refuses to open shards that differ from the recorded layout.
+VECTOR_DB_SHARDS = [shard.strip() for shard in getenv('VECTOR_DB_SHARDS', VECTOR_DB_PATH).split(',') if shard.strip()]
+VECTOR_DB_SHARD_ROUTING_KEY = getenv('VECTOR_DB_SHARD_ROUTING_KEY', 'url')
+VECTOR_DB_SHARD_MANIFEST = getenv('VECTOR_DB_SHARD_MANIFEST', "chatbot-rag-db-shards.json")
 DEFAULT_COLLECTION_NAME = "chatbot-rag-db-collection-v1"
+# Single-flight coalescing: identical concurrent scrapes, query embeddings and answers share one execution,
+# across threads and gunicorn workers. A result stays shareable for SINGLE_FLIGHT_RESULT_TTL seconds after
+# it completes, and a worker holding a call for longer than SINGLE_FLIGHT_LEASE_SECONDS is assumed dead.
+# Callers stop waiting on another one after SINGLE_FLIGHT_WAIT_SECONDS and run the call themselves. Both
+# stay below the gunicorn worker timeout (60s), leaving a waiter time to run the call itself.
+SINGLE_FLIGHT_ENABLED = getenv('SINGLE_FLIGHT_ENABLED', 'true').lower() == 'true'
+SINGLE_FLIGHT_DB_PATH = getenv('SINGLE_FLIGHT_DB_PATH', "chatbot-rag-db-single-flight.sqlite3")
+SINGLE_FLIGHT_LEASE_SECONDS = 45
+SINGLE_FLIGHT_RESULT_TTL = 2
+SINGLE_FLIGHT_WAIT_SECONDS = 20
 PROMPT_GENERATE_ANSWER = """you are an AI agent that can answer user questions based on the knowledge you have from the weblinks.
 If the user query is not related to the documents and is about some other topics then just say "I don't quite get that. I don't have this information."
 But if the user query is very basic like greetings and salutations, then reply appropriately.
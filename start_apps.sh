@@ -7,6 +7,10 @@ pkill -f python3
 # Wait for processes to terminate (optional)
 sleep 2
 
+# Move the vector DB data onto the configured shards, if they changed
+echo "Rebalancing the vector DB shards..."
+python3 -m app.rag.sharding || exit 1
+
 # Start the Python application using uvicorn (adjust with your app's entry point)
 echo "Starting the Python app using"
 nohup python3 main.py > api.log 2>&1 &
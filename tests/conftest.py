@@ -0,0 +1,22 @@
+"""Keeps the runtime files of the app out of the working directory during the tests"""
+
+import os
+import shutil
+import tempfile
+
+RUNTIME_DIR = tempfile.mkdtemp(prefix='rag-api-tests-')
+
+# config reads the environment when it is first imported, which happens after this module is loaded
+os.environ.update({
+    'ENCODER': 'hashing',
+    'VECTOR_DB_PATH': os.path.join(RUNTIME_DIR, 'chatbot-rag-db'),
+    'VECTOR_DB_SHARDS': os.path.join(RUNTIME_DIR, 'chatbot-rag-db'),
+    'VECTOR_DB_SHARD_MANIFEST': os.path.join(RUNTIME_DIR, 'chatbot-rag-db-shards.json'),
+    'DEDUP_INDEX_PATH': os.path.join(RUNTIME_DIR, 'chatbot-rag-db-dedup.sqlite3'),
+    'SINGLE_FLIGHT_DB_PATH': os.path.join(RUNTIME_DIR, 'chatbot-rag-db-single-flight.sqlite3'),
+})
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(RUNTIME_DIR, ignore_errors=True)
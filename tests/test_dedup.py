@@ -0,0 +1,98 @@
+import threading
+from time import sleep
+
+from app.rag.dedup import DedupIndex, simhash
+
+PAGE = ("ColBERT is a late interaction retrieval model that encodes queries and documents into token level "
+        "embeddings and scores them with a sum of maximum similarities across all of the query tokens.")
+FOOTER = "Accept cookies to continue browsing. We use cookies for analytics and to improve the site for you."
+
+
+def test_simhash_ignores_case_and_separates_distinct_texts():
+    assert simhash(PAGE) == simhash(PAGE.upper())
+    assert bin(simhash(PAGE) ^ simhash(FOOTER)).count('1') > 3
+
+
+def test_partition_finds_indexed_and_repeated_chunks(tmp_path):
+    index = DedupIndex(str(tmp_path / "dedup.sqlite3"))
+
+    unique, duplicates, reservation = index.partition("collection", [PAGE, FOOTER, FOOTER], "https://a")
+    assert [chunk for chunk, _, _ in unique] == [PAGE, FOOTER]
+    assert duplicates == []
+    index.commit(reservation)
+
+    unique, duplicates, _ = index.partition("collection", [FOOTER, "A brand new chunk of text."], "https://b")
+    assert [chunk for chunk, _, _ in unique] == ["A brand new chunk of text."]
+    assert duplicates == [(index.find("collection", simhash(FOOTER))[0], "https://a", False)]
+
+    # Other collections are independent
+    assert index.partition("other", [FOOTER], "https://a")[1] == []
+
+
+def test_reservations_are_pending_until_committed_or_released(tmp_path):
+    index = DedupIndex(str(tmp_path / "dedup.sqlite3"))
+    unique, _, reservation = index.partition("collection", [FOOTER], "https://a")
+    point_id = unique[0][2]
+
+    # Another request sees the reserved chunk as a pending duplicate
+    assert index.partition("collection", [FOOTER], "https://b")[:2] == ([], [(point_id, "https://a", True)])
+    assert index.pending("collection", [point_id]) == [point_id]
+    index.commit(reservation)
+    assert index.pending("collection", [point_id]) == []
+    index.wait("collection", [point_id])
+    assert index.partition("collection", [FOOTER], "https://b")[1] == [(point_id, "https://a", False)]
+
+    unique, _, reservation = index.partition("collection", [PAGE], "https://a")
+    index.release(reservation)
+    assert [chunk for chunk, _, _ in index.partition("collection", [PAGE], "https://b")[0]] == [PAGE]
+
+
+def test_abandoned_reservations_expire(tmp_path):
+    index = DedupIndex(str(tmp_path / "dedup.sqlite3"), reservation_seconds=0.2)
+    unique, _, _ = index.partition("collection", [FOOTER], "https://a")
+    assert index.find("collection", simhash(FOOTER)) == (unique[0][2], "https://a")
+    sleep(0.3)
+
+    index.wait("collection", [unique[0][2]])
+    assert index.find("collection", simhash(FOOTER)) is None
+    unique, duplicates, _ = index.partition("collection", [FOOTER], "https://b")
+    assert [chunk for chunk, _, _ in unique] == [FOOTER] and duplicates == []
+
+
+def test_concurrent_partitions_reserve_a_shared_chunk_once(tmp_path):
+    db_path = str(tmp_path / "dedup.sqlite3")
+    barrier, results = threading.Barrier(2), {}
+
+    def _partition(url):
+        index = DedupIndex(db_path)
+        barrier.wait()
+        results[url] = index.partition("collection", [f"Page of {url} with its own content.", FOOTER], url)
+
+    threads = [threading.Thread(target=_partition, args=(url,)) for url in ("https://a", "https://b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    reserved = [url for url, (unique, _, _) in results.items() if FOOTER in [chunk for chunk, _, _ in unique]]
+    waiting = [url for url, (_, duplicates, _) in results.items() if [pending for *_, pending in duplicates] == [True]]
+    assert len(reserved) == 1 and len(waiting) == 1 and reserved != waiting
+
+
+def test_remove_drops_stale_fingerprints_and_references(tmp_path):
+    index = DedupIndex(str(tmp_path / "dedup.sqlite3"))
+    index.add("collection", [(simhash(FOOTER), "point-1", "https://a")])
+    index.reference("collection", [("point-1", "https://b"), ("point-1", "https://b"), ("point-1", "https://c")])
+    assert index.urls("collection", "point-1") == ["https://b", "https://c"]
+
+    index.remove("collection", ["point-1"])
+    assert index.partition("collection", [FOOTER], "https://b")[1] == []
+    assert index.urls("collection", "point-1") == []
+
+
+def test_stats_accumulate(tmp_path):
+    index = DedupIndex(str(tmp_path / "dedup.sqlite3"))
+    index.record("collection", 4, 1)
+    index.record("collection", 6, 4)
+
+    assert index.stats("collection") == {"chunks": 10, "duplicates": 5, "dedup_rate": 0.5}
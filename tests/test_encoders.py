@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from app.rag.encoders import Encoder, HashingEncoder, OpenAIEncoder, get_encoder
+from config import EMBEDDING_MODEL_NAME
+
+
+def test_encoder_is_abstract():
+    with pytest.raises(TypeError):
+        Encoder()
+
+
+def test_hashing_encoder_shape_dtype_and_norm():
+    encoder = HashingEncoder(dimension=256)
+    vectors = encoder.encode_batch(["The quick brown fox", "Qdrant vector search", "é"])
+
+    assert vectors.shape == (3, 256)
+    assert vectors.dtype == np.float32
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0, atol=1e-6)
+    assert encoder.encode("The quick brown fox").shape == (256,)
+
+
+def test_hashing_encoder_is_deterministic_and_similarity_preserving():
+    encoder = HashingEncoder(dimension=1024)
+    first, near, far = encoder.encode_batch(["the quick brown fox", "the quick brown foxes", "qdrant vector search"])
+
+    assert np.array_equal(first, encoder.encode("the quick brown fox"))
+    assert first @ near > first @ far
+
+
+def test_hashing_encoder_handles_empty_inputs():
+    encoder = HashingEncoder(dimension=64)
+
+    assert encoder.encode_batch([]).shape == (0, 64)
+    assert not encoder.encode("").any()
+
+
+def test_get_encoder_rejects_unknown_names():
+    assert isinstance(get_encoder(encoder_name='hashing'), HashingEncoder)
+    with pytest.raises(ValueError):
+        get_encoder(encoder_name='unknown')
+
+
+def test_check_vector_name_rejects_other_encoders():
+    encoder = HashingEncoder(dimension=1024)
+
+    encoder.check_vector_name("collection", encoder.name)
+    with pytest.raises(ValueError, match="was built with encoder"):
+        encoder.check_vector_name("collection", HashingEncoder(dimension=512).name)
+    # Unnamed vectors predate encoders and come from the OpenAI model
+    with pytest.raises(ValueError, match=EMBEDDING_MODEL_NAME):
+        encoder.check_vector_name("collection", None)
+    OpenAIEncoder(client=None).check_vector_name("collection", None)
+
+
+def test_only_remote_encoders_are_coalesced():
+    assert not HashingEncoder().is_remote
+    assert OpenAIEncoder(client=None).is_remote
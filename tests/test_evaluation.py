@@ -0,0 +1,119 @@
+from types import SimpleNamespace
+
+import pytest
+from qdrant_client.http.models import (BinaryQuantization, BinaryQuantizationConfig, HnswConfigDiff,
+                                       ScalarQuantization, ScalarQuantizationConfig, ScalarType, VectorParams)
+
+from app.rag import evaluation
+
+HIT_A = {"url": "https://a", "text": "ColBERT uses late interaction."}
+HIT_B = {"url": "https://b", "text": "SPLADE learns sparse weights."}
+HIT_C = {"url": "https://c", "text": "Cookie banner."}
+
+
+def test_matched_targets_matches_urls_and_chunk_snippets():
+    assert evaluation.matched_targets(HIT_A, {"https://a"}, ["late interaction", "sparse"]) == {
+        ("url", "https://a"), ("chunk", "late interaction")
+    }
+    assert evaluation.matched_targets(HIT_C, {"https://a"}, ["late interaction"]) == set()
+    assert evaluation.matched_targets({"text": "late interaction"}, {"https://a"}, []) == set()
+
+
+def test_score_hits_gives_recall_and_reciprocal_rank():
+    assert evaluation.score_hits([HIT_C, HIT_A, HIT_B], {"https://a", "https://d"}, ["sparse"]) == (2 / 3, 1 / 2)
+    assert evaluation.score_hits([HIT_A], set(), ["late interaction"]) == (1.0, 1.0)
+    assert evaluation.score_hits([HIT_C], {"https://a"}, []) == (0.0, 0.0)
+    # A target matched by several hits counts once
+    assert evaluation.score_hits([HIT_A, HIT_A], {"https://a"}, []) == (1.0, 1.0)
+
+
+def test_evaluate_configuration_averages_recall_and_mrr(monkeypatch):
+    hits_by_query = {"q1": [HIT_A, HIT_B], "q2": [HIT_C, HIT_B], "q3": [HIT_C]}
+    monkeypatch.setattr(evaluation, 'check_collection_encoder', lambda collection_name: None)
+    monkeypatch.setattr(evaluation, 'get_vector_layout', lambda collection_name: ("encoder", None, 0))
+    monkeypatch.setattr(evaluation, 'estimate_memory_footprint', lambda collection_name: {"points": 3, "ram_bytes": 1})
+    monkeypatch.setattr(
+        evaluation, 'search_embedding',
+        lambda query, *args: [SimpleNamespace(payload=payload) for payload in hits_by_query[query]]
+    )
+    labeled_queries = [
+        {"query": "q1", "relevant_urls": ["https://a"]},
+        {"query": "q2", "relevant_urls": ["https://b"], "relevant_chunks": ["late interaction"]},
+        {"query": "q3", "relevant_chunks": ["sparse"]},
+    ]
+
+    result = evaluation.evaluate_configuration(
+        {"name": "baseline", "collection_name": "collection", "limit": 2}, labeled_queries, ["q1", "q2", "q3"]
+    )
+    assert result["recall_at_k"] == round((1 + 0.5 + 0) / 3, 4)
+    assert result["mrr"] == round((1 + 0.5 + 0) / 3, 4)
+    assert len(result["latencies_ms"]) == 3
+    assert result["k"] == 2 and result["search_dimension"] is None and result["ram_bytes"] == 1
+
+
+def _result(name, recall, mrr, p50_ms, ram_bytes):
+    return {"name": name, "recall_at_k": recall, "mrr": mrr, "p50_ms": p50_ms, "ram_bytes": ram_bytes}
+
+
+def test_mark_pareto_front_keeps_the_non_dominated_results():
+    results = evaluation.mark_pareto_front([
+        _result("exact", 1.0, 0.9, 20.0, 100),
+        _result("fast", 0.8, 0.7, 2.0, 100),
+        _result("dominated", 0.8, 0.7, 5.0, 100),
+        _result("small", 0.7, 0.6, 10.0, 10),
+        _result("copy-of-fast", 0.8, 0.7, 2.0, 100),
+    ])
+    assert {result["name"]: result["pareto"] for result in results} == {
+        "exact": True, "fast": True, "dominated": False, "small": True, "copy-of-fast": True
+    }
+
+
+def _collection_info(vectors, quantization_config=None):
+    return SimpleNamespace(config=SimpleNamespace(
+        params=SimpleNamespace(vectors=vectors), quantization_config=quantization_config,
+        hnsw_config=SimpleNamespace(m=16)
+    ))
+
+
+@pytest.mark.parametrize('vectors, quantization_config, ram_bytes', [
+    # 10 points of 4 float32 plus 2 * m links of 4 bytes per point
+    (VectorParams(size=4, distance="Cosine"), None, 10 * 4 * 4 + 10 * 16 * 2 * 4),
+    # Full vectors on disk without a graph, the int8 copies of both vectors stay in RAM
+    ({"full": VectorParams(size=8, distance="Cosine", on_disk=True, hnsw_config=HnswConfigDiff(m=0)),
+      "truncated": VectorParams(size=4, distance="Cosine")},
+     ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8)),
+     10 * 8 + 10 * 4 * 4 + 10 * 4 + 10 * 16 * 2 * 4),
+    # Binary quantization keeps one bit per dimension, rounded up to bytes
+    (VectorParams(size=12, distance="Cosine", on_disk=True,
+                  quantization_config=BinaryQuantization(binary=BinaryQuantizationConfig())),
+     None, 10 * 2 + 10 * 16 * 2 * 4),
+])
+def test_estimate_memory_footprint(monkeypatch, vectors, quantization_config, ram_bytes):
+    client = SimpleNamespace(
+        get_collection=lambda collection_name: _collection_info(vectors, quantization_config),
+        count=lambda collection_name: 10
+    )
+    monkeypatch.setattr(evaluation, 'qclient', client)
+    assert evaluation.estimate_memory_footprint("collection") == {"points": 10, "ram_bytes": ram_bytes}
+
+
+@pytest.mark.parametrize('labeled_queries, configurations, message', [
+    ([], [{"collection_name": "c"}], "non-empty JSON list"),
+    ({"query": "q"}, [{"collection_name": "c"}], "non-empty JSON list"),
+    ([{"relevant_urls": ["https://a"]}], [{"collection_name": "c"}], "no 'query' text"),
+    ([{"query": "q"}], [{"collection_name": "c"}], "relevant_urls"),
+    ([{"query": "q", "relevant_urls": [], "relevant_chunks": []}], [{"collection_name": "c"}], "relevant_urls"),
+    ([{"query": "q", "relevant_urls": "https://a"}], [{"collection_name": "c"}], "relevant_urls"),
+    ([{"query": "q", "relevant_urls": ["https://a"]}], [], "non-empty JSON list"),
+    ([{"query": "q", "relevant_urls": ["https://a"]}], [{"name": "c"}], "collection_name"),
+])
+def test_validate_inputs_rejects_unusable_files(labeled_queries, configurations, message):
+    with pytest.raises(ValueError, match=message):
+        evaluation.validate_inputs(labeled_queries, configurations)
+
+
+def test_validate_inputs_accepts_urls_or_chunks():
+    evaluation.validate_inputs(
+        [{"query": "q1", "relevant_urls": ["https://a"]}, {"query": "q2", "relevant_chunks": ["snippet"]}],
+        [{"collection_name": "c"}]
+    )
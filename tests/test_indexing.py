@@ -0,0 +1,88 @@
+import threading
+from time import sleep
+from types import SimpleNamespace
+
+import pytest
+
+from app.rag import services
+from app.utilities.single_flight import get_single_flight_stats
+
+FOOTER = "Accept cookies to continue browsing. We use cookies for analytics and to improve the site for you."
+PAGES = {
+    "https://example.com/colbert": "ColBERT scores queries against documents with late interaction over token embeddings.",
+    "https://example.com/splade": "SPLADE expands queries and documents into sparse vocabulary weights learned end to end.",
+}
+
+
+@pytest.fixture
+def slow_indexing(monkeypatch):
+    """
+    Serves the pages without Firecrawl or NLTK and makes the embedding slow enough
+    for concurrent requests to overlap. Returns the scraped URLs and the upserted batches.
+    """
+    calls = SimpleNamespace(scrapes=[], upserts=[])
+    encode_texts, upsert = services.encode_texts, services.qclient.upsert
+
+    def _scrape(url):
+        calls.scrapes.append(url)
+        return f"{PAGES[url]}\n\n{FOOTER}"
+
+    def _encode_texts(texts):
+        sleep(0.3)
+        return encode_texts(texts)
+
+    def _upsert(collection_name, points, **kwargs):
+        calls.upserts.append(points)
+        return upsert(collection_name=collection_name, points=points, **kwargs)
+
+    monkeypatch.setattr(services, 'scrape_content_from_url', _scrape)
+    monkeypatch.setattr(services, 'get_chunks', lambda text, chunk_sentences: text.split("\n\n"))
+    monkeypatch.setattr(services, 'encode_texts', _encode_texts)
+    monkeypatch.setattr(services.qclient, 'upsert', _upsert)
+    return calls
+
+
+def _index_concurrently(urls, collection_name):
+    results = []
+    threads = [
+        threading.Thread(target=lambda url=url: results.append(services.process_urls_for_indexing([url], collection_name)))
+        for url in urls
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_concurrent_pages_store_a_shared_chunk_once(slow_indexing):
+    services.create_collection("indexing-dedup")
+
+    results = _index_concurrently(list(PAGES), "indexing-dedup")
+    assert sorted(url for indexed, failed, _ in results for url in indexed) == sorted(PAGES)
+    assert sum(dedup["duplicates"] for _, _, dedup in results) == 1
+
+    records = services.fetch_all_records("indexing-dedup", limit=10)
+    footers = [record for record in records if record["payload"]["text"] == FOOTER]
+    assert len(records) == 3 and len(footers) == 1
+    assert footers[0]["duplicate_urls"] == [url for url in PAGES if url != footers[0]["payload"]["url"]]
+    assert services.get_dedup_stats("indexing-dedup") == {"chunks": 4, "duplicates": 1, "dedup_rate": 0.25}
+
+
+def test_concurrent_requests_for_a_url_index_it_once(slow_indexing, monkeypatch):
+    # Without dedup, nothing but the coalescing keeps the page from being stored twice
+    monkeypatch.setattr(services, 'dedup_index', None)
+    services.create_collection("indexing-single-flight")
+    url = "https://example.com/colbert"
+
+    results = _index_concurrently([url, url, url], "indexing-single-flight")
+    assert [indexed for indexed, _, _ in results] == [[url]] * 3
+    assert slow_indexing.scrapes == [url]
+    assert len(slow_indexing.upserts) == 1
+    assert services.qclient.count("indexing-single-flight") == 2
+    assert get_single_flight_stats()["index_url"]["saved"] == 2
+
+
+def test_local_encoder_is_not_coalesced():
+    assert services.encode_text("qdrant vector search") == services.encode_texts(["qdrant vector search"])[0].tolist()
+    assert not any(name.startswith("encode_text") for name in get_single_flight_stats())
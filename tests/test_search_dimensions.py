@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+from qdrant_client.http.models import Batch
+
+from app.rag import services
+
+WORDS = ["vector", "search", "qdrant", "shard", "embedding", "chunk", "rescoring", "latency", "recall", "index",
+         "query", "cosine", "footer", "crawler", "markdown", "token"]
+
+
+def _texts(count):
+    rng = np.random.default_rng(0)
+    return [' '.join(rng.choice(WORDS, size=8)) + f" document {i}" for i in range(count)]
+
+
+@pytest.fixture
+def truncatable_encoder(monkeypatch):
+    # The hashing encoder is not Matryoshka trained, but the two-stage mechanics do not depend on it
+    monkeypatch.setattr(services.encoder, 'supports_truncation', True)
+
+
+def _create_collection(name, search_dimension, texts):
+    services.create_collection(name, search_dimension)
+    embeddings = services.encode_texts(texts)
+    ids = [f"00000000-0000-0000-0000-{i:012d}" for i in range(len(texts))]
+    services.qclient.upsert(
+        collection_name=name,
+        points=Batch(
+            ids=ids,
+            vectors=services.build_point_vectors(name, embeddings),
+            payloads=[{"text": text, "url": f"https://example.com/{i}"} for i, text in enumerate(texts)]
+        )
+    )
+    return ids, embeddings
+
+
+def test_truncate_embeddings_keeps_a_normalized_prefix():
+    embeddings = np.array([[3.0, 4.0, 12.0], [0.0, 0.0, 5.0]])
+
+    truncated = services.truncate_embeddings(embeddings, 2)
+    assert truncated.dtype == np.float32
+    assert np.allclose(truncated, [[0.6, 0.8], [0.0, 0.0]])
+    assert np.allclose(services.truncate_embeddings([3.0, 4.0, 12.0], 2), [0.6, 0.8])
+
+
+def test_create_collection_validates_the_search_dimension(truncatable_encoder):
+    with pytest.raises(Exception):
+        services.build_vectors_config(services.encoder.dimension)
+
+    config = services.build_vectors_config(64)
+    full = config[services.encoder.name]
+    assert full.on_disk and full.hnsw_config.m == 0
+    assert config[f"{services.encoder.name}-64"].size == 64
+
+
+def test_two_stage_search_rescores_the_truncated_candidates(truncatable_encoder):
+    texts = _texts(40)
+    ids, embeddings = _create_collection("two-stage", 64, texts)
+    assert services.get_vector_layout("two-stage") == (services.encoder.name, f"{services.encoder.name}-64", 64)
+
+    query = services.encode_texts(["qdrant vector search latency"])[0]
+    full_ranking = [ids[i] for i in np.argsort(-(embeddings @ query))]
+    truncated = services.truncate_embeddings(embeddings, 64)
+    truncated_ranking = [ids[i] for i in np.argsort(-(truncated @ services.truncate_embeddings(query, 64)))]
+
+    # Without oversampling, the first pass keeps the truncated top-5, which are reordered by full score
+    hits = services.search_embedding(query.tolist(), "two-stage", limit=5, oversampling=1)
+    assert {str(hit.id) for hit in hits} == set(truncated_ranking[:5])
+    assert [str(hit.id) for hit in hits] == [point_id for point_id in full_ranking if point_id in truncated_ranking[:5]]
+    assert np.allclose([hit.score for hit in hits], [embeddings[ids.index(str(hit.id))] @ query for hit in hits],
+                       atol=1e-4)
+
+    # Oversampling over every point gives back the exact full-dimension top-k
+    hits = services.search_embedding(query.tolist(), "two-stage", limit=5, oversampling=8)
+    assert [str(hit.id) for hit in hits] == full_ranking[:5]
+
+
+def test_report_searches_temporary_collections(truncatable_encoder):
+    _create_collection("report", 0, _texts(40))
+    collections = {collection.name for collection in services.qclient.clients[0].get_collections().collections}
+
+    report = services.report_search_dimensions("report", [64, 256], limit=3, sample_size=10, max_points=30)
+    assert report["points"] == 30
+    assert report["sample_truncated"] is True
+    assert report["queries"] == 10
+    assert [row["dimension"] for row in report["dimensions"]] == [64, 256]
+    for row in report["dimensions"]:
+        assert 0 <= row["recall_at_k"] <= 1 and row["p50_ms"] > 0 and row["speedup"] > 0
+    # Local storage searches exactly, so the full vectors find the exact top-k
+    assert report["full_recall_at_k"] == 1.0
+    assert not services.report_search_dimensions("report", [64], limit=3, max_points=100)["sample_truncated"]
+
+    # The temporary collections are gone
+    assert {collection.name for collection in services.qclient.clients[0].get_collections().collections} == collections
+
+    with pytest.raises(Exception):
+        services.report_search_dimensions("report", [services.encoder.dimension], limit=3)
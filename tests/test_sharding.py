@@ -0,0 +1,140 @@
+from json import load
+
+import numpy as np
+import pytest
+from qdrant_client.http.models import Batch, VectorParams
+
+from app.rag.sharding import ShardedQdrant, jump_hash, open_sharded_client, rebalance_shards
+
+COLLECTION = "collection"
+DIMENSION = 8
+
+
+def _points(count=50):
+    vectors = np.random.default_rng(0).normal(size=(count, DIMENSION)).astype(np.float32)
+    ids = [f"00000000-0000-0000-0000-{i:012d}" for i in range(count)]
+    payloads = [{"url": f"https://example.com/{i % 20}", "text": f"chunk {i}"} for i in range(count)]
+    return ids, vectors, payloads
+
+
+def _open(locations, routing_key='url', points=None):
+    client = ShardedQdrant([str(location) for location in locations], routing_key=routing_key)
+    if points:
+        ids, vectors, payloads = points
+        client.create_collection(COLLECTION, vectors_config=VectorParams(size=DIMENSION, distance="Cosine"))
+        client.upsert(COLLECTION, points=Batch(ids=ids, vectors=vectors.tolist(), payloads=payloads))
+    return client
+
+
+def _stored_ids(client):
+    records, offset = client.scroll(COLLECTION, limit=1000)
+    assert offset is None
+    return sorted(str(record.id) for record in records)
+
+
+def test_jump_hash_only_moves_keys_to_the_new_bucket():
+    keys = range(0, 2 ** 40, 2 ** 40 // 2000)
+    for num_buckets in (1, 2, 5, 9):
+        before = [jump_hash(key, num_buckets) for key in keys]
+        after = [jump_hash(key, num_buckets + 1) for key in keys]
+        assert before == [jump_hash(key, num_buckets) for key in keys]
+        assert all(old == new or new == num_buckets for old, new in zip(before, after))
+        # Roughly 1 / (N + 1) of the keys move
+        moved = sum(old != new for old, new in zip(before, after)) / len(before)
+        assert abs(moved - 1 / (num_buckets + 1)) < 0.05
+
+
+def test_points_are_routed_by_url_or_id(tmp_path):
+    by_url = _open([tmp_path / "url-0", tmp_path / "url-1", tmp_path / "url-2"])
+    by_id = _open([tmp_path / "id-0", tmp_path / "id-1", tmp_path / "id-2"], routing_key='id')
+    try:
+        payload = {"url": "https://example.com/page"}
+        assert len({by_url.shard_for(f"point-{i}", payload) for i in range(30)}) == 1
+        assert len({by_id.shard_for(f"point-{i}", payload) for i in range(30)}) > 1
+        # Without a URL the point id is the key
+        assert by_url.shard_for("point-1") == by_id.shard_for("point-1", payload)
+    finally:
+        by_url.close()
+        by_id.close()
+
+
+def test_merged_top_k_matches_a_single_shard(tmp_path):
+    points = _points()
+    single = _open([tmp_path / "single"], points=points)
+    sharded = _open([tmp_path / "shard-0", tmp_path / "shard-1", tmp_path / "shard-2"], points=points)
+    try:
+        # The batch was split over every shard
+        assert sharded.count(COLLECTION) == 50
+        assert all(client.count(COLLECTION).count for client in sharded.clients)
+
+        for query in np.random.default_rng(1).normal(size=(5, DIMENSION)).tolist():
+            expected = [(hit.id, round(hit.score, 5)) for hit in single.search(COLLECTION, query_vector=query, limit=7)]
+            hits = sharded.search(COLLECTION, query_vector=query, limit=7)
+            assert [(hit.id, round(hit.score, 5)) for hit in hits] == expected
+            hits = sharded.query_points(COLLECTION, query=query, limit=7)
+            assert [(hit.id, round(hit.score, 5)) for hit in hits] == expected
+    finally:
+        single.close()
+        sharded.close()
+
+
+def test_scroll_pages_across_shards(tmp_path):
+    points = _points()
+    client = _open([tmp_path / "shard-0", tmp_path / "shard-1", tmp_path / "shard-2"], points=points)
+    try:
+        seen, offset = [], None
+        while True:
+            records, offset = client.scroll(COLLECTION, limit=7, offset=offset)
+            assert len(records) <= 7
+            seen.extend(str(record.id) for record in records)
+            if offset is None:
+                break
+        assert sorted(seen) == sorted(points[0])
+    finally:
+        client.close()
+
+
+def test_rebalance_keeps_every_point(tmp_path):
+    ids, vectors, payloads = points = _points()
+    manifest = str(tmp_path / "shards.json")
+    legacy = str(tmp_path / "shard-0")
+    _open([legacy], points=points).close()
+
+    for locations in ([legacy, str(tmp_path / "shard-1"), str(tmp_path / "shard-2")], [legacy, str(tmp_path / "shard-1")]):
+        rebalance_shards(locations, manifest, legacy)
+        with open(manifest) as manifest_file:
+            assert load(manifest_file)['shards'] == locations
+
+        client = open_sharded_client(locations, manifest, legacy)
+        try:
+            assert _stored_ids(client) == sorted(ids)
+            # Every point sits on its owning shard, with its payload and vector
+            for shard, shard_client in enumerate(client.clients):
+                records, _ = shard_client.scroll(COLLECTION, limit=1000, with_vectors=True)
+                for record in records:
+                    position = ids.index(str(record.id))
+                    assert client.shard_for(record.id, record.payload) == shard
+                    assert record.payload == payloads[position]
+                    assert np.allclose(record.vector, vectors[position], atol=1e-5)
+        finally:
+            client.close()
+
+
+def test_open_refuses_a_changed_layout(tmp_path):
+    points = _points()
+    manifest = str(tmp_path / "shards.json")
+    legacy = str(tmp_path / "shard-0")
+    _open([legacy], points=points).close()
+
+    with pytest.raises(Exception, match="rebalance"):
+        open_sharded_client([legacy, str(tmp_path / "shard-1")], manifest, legacy)
+    assert rebalance_shards([legacy], manifest, legacy) == 0
+    with pytest.raises(Exception, match="routing key"):
+        open_sharded_client([legacy], manifest, legacy, routing_key='id')
+
+    # Nothing was moved
+    client = open_sharded_client([legacy], manifest, legacy)
+    try:
+        assert _stored_ids(client) == sorted(points[0])
+    finally:
+        client.close()
@@ -0,0 +1,216 @@
+import multiprocessing
+import sqlite3
+import threading
+from contextlib import closing
+from os import getpid
+from time import sleep
+
+import pytest
+
+from app.utilities.single_flight import SingleFlight, get_single_flight_stats, single_flight
+
+
+def _run_threads(group, function, count=5):
+    """
+    Calls the same key from `count` threads while the leader's function is blocked,
+    and returns the results, or the errors, of every thread.
+    """
+    started, release = threading.Event(), threading.Event()
+    outcomes = []
+
+    def _blocked():
+        started.set()
+        release.wait(5)
+        return function()
+
+    def _caller():
+        try:
+            outcomes.append(group.call('function', 'key', _blocked))
+        except Exception as err:
+            outcomes.append(err)
+
+    threads = [threading.Thread(target=_caller) for _ in range(count)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return outcomes
+
+
+def test_threads_share_one_execution():
+    group = SingleFlight()
+    executions = []
+
+    outcomes = _run_threads(group, lambda: executions.append(1) or 'answer')
+    assert outcomes == ['answer'] * 5
+    assert len(executions) == 1
+    assert group.stats()['function'] == {
+        'executions': 1, 'shared_threads': 4, 'shared_workers': 0, 'wait_timeouts': 0, 'saved': 4
+    }
+
+
+def test_threads_share_errors():
+    group = SingleFlight()
+
+    def _fail():
+        raise ValueError('scrape failed')
+
+    outcomes = _run_threads(group, _fail)
+    assert len(outcomes) == 5
+    assert all(isinstance(outcome, ValueError) and str(outcome) == 'scrape failed' for outcome in outcomes)
+    assert group.stats()['function']['executions'] == 1
+
+
+def test_thread_waiters_time_out_and_run_the_call():
+    group = SingleFlight(wait_seconds=0.1)
+    release = threading.Event()
+    leader = threading.Thread(target=group.call, args=('function', 'key', lambda: release.wait(5)))
+    leader.start()
+    sleep(0.05)
+
+    assert group.call('function', 'key', lambda: 'own') == 'own'
+    release.set()
+    leader.join(5)
+    assert group.stats()['function']['wait_timeouts'] == 1
+
+
+def _call_in_worker(db_path):
+    group = SingleFlight(db_path, lease_seconds=10, wait_seconds=10)
+
+    def _slow():
+        sleep(1)
+        return getpid()
+
+    return group.call('function', 'key', _slow)
+
+
+def _fail_in_worker(db_path):
+    group = SingleFlight(db_path, lease_seconds=10, wait_seconds=10)
+
+    def _fail():
+        sleep(1)
+        raise ValueError('generation failed')
+
+    try:
+        group.call('function', 'key', _fail)
+    except Exception as err:
+        return str(err)
+
+
+def test_workers_share_one_execution(tmp_path):
+    db_path = str(tmp_path / "single-flight.sqlite3")
+    with multiprocessing.Pool(4) as pool:
+        results = pool.map(_call_in_worker, [db_path] * 4, chunksize=1)
+
+    # Every worker got the pid of the one worker that ran the call
+    assert len(set(results)) == 1
+    stats = SingleFlight(db_path).stats()['function']
+    assert stats['executions'] == 1
+    assert stats['shared_workers'] == 3
+
+
+def test_workers_share_errors(tmp_path):
+    db_path = str(tmp_path / "single-flight.sqlite3")
+    with multiprocessing.Pool(4) as pool:
+        results = pool.map(_fail_in_worker, [db_path] * 4, chunksize=1)
+
+    assert results == ['generation failed'] * 4
+    assert SingleFlight(db_path).stats()['function']['executions'] == 1
+
+
+def _hold_lease(db_path, key, lease_seconds):
+    # A worker that took the lease and died before finishing the call
+    dead = SingleFlight(db_path, lease_seconds=lease_seconds)
+    with closing(dead._connect()) as connection:
+        assert dead._claim(connection, key) is None
+    return dead.owner
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    db_path = str(tmp_path / "single-flight.sqlite3")
+    _hold_lease(db_path, 'key', lease_seconds=0.3)
+
+    group = SingleFlight(db_path, lease_seconds=0.3, wait_seconds=10)
+    assert group.call('function', 'key', lambda: 'recovered') == 'recovered'
+    assert group.stats()['function']['executions'] == 1
+
+    # The result was published under the new owner
+    with closing(sqlite3.connect(db_path)) as connection:
+        owner, finished = connection.execute("SELECT owner, finished FROM calls WHERE key = 'key'").fetchone()
+    assert owner == group.owner and finished is not None
+
+
+def test_worker_waiters_time_out_and_run_the_call(tmp_path):
+    db_path = str(tmp_path / "single-flight.sqlite3")
+    owner = _hold_lease(db_path, 'key', lease_seconds=60)
+
+    group = SingleFlight(db_path, lease_seconds=60, wait_seconds=0.2)
+    assert group.call('function', 'key', lambda: 'own') == 'own'
+    assert group.stats()['function'] == {
+        'executions': 0, 'shared_threads': 0, 'shared_workers': 0, 'wait_timeouts': 1, 'saved': 0
+    }
+
+    # The lease of the slow worker is left untouched
+    with closing(sqlite3.connect(db_path)) as connection:
+        row = connection.execute("SELECT owner, finished FROM calls WHERE key = 'key'").fetchone()
+    assert row == (owner, None)
+
+
+def test_results_are_shared_as_json(tmp_path):
+    db_path = str(tmp_path / "single-flight.sqlite3")
+    leader, follower = SingleFlight(db_path, result_ttl=10), SingleFlight(db_path, result_ttl=10)
+
+    assert leader.call('function', 'key', lambda: ("answer", ["https://a"])) == ("answer", ["https://a"])
+    # Another worker reads the fresh result back instead of running the call
+    assert follower.call('function', 'key', lambda: pytest.fail('ran twice')) == ["answer", ["https://a"]]
+    with closing(sqlite3.connect(db_path)) as connection:
+        result, = connection.execute("SELECT result FROM calls WHERE key = 'key'").fetchone()
+    assert result == '["answer", ["https://a"]]'
+
+    with pytest.raises(TypeError):
+        leader.call('function', 'other', lambda: object())
+    with pytest.raises(Exception, match='not JSON serializable'):
+        follower.call('function', 'other', lambda: pytest.fail('ran twice'))
+
+
+def test_database_is_created_on_first_use(tmp_path):
+    db_path = tmp_path / "single-flight.sqlite3"
+    group = SingleFlight(str(db_path))
+    assert not db_path.exists()
+
+    assert group.call('function', 'key', lambda: 'answer') == 'answer'
+    assert db_path.exists()
+
+
+def test_disabled_coalescing_calls_the_function_directly():
+    @single_flight('local', enabled=False)
+    def _local(text):
+        return text.upper()
+
+    assert _local('text') == 'TEXT'
+    assert 'local' not in get_single_flight_stats()
+
+
+def _report_owner(group, queue):
+    queue.put(group.owner)
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='requires fork')
+def test_forked_workers_get_their_own_owner():
+    # gunicorn --preload builds the group once and forks the workers from it
+    group = SingleFlight()
+    parent_owner = group.owner
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=_report_owner, args=(group, queue))
+    process.start()
+    child_owner = queue.get(timeout=5)
+    process.join(5)
+
+    assert child_owner != parent_owner
+    assert child_owner.startswith(f"{process.pid}-")
+    assert group.owner == parent_owner